@@ -0,0 +1,58 @@
+import argparse
+import os
+import sqlite3
+
+# rows are updated in rowid ranges of this size, one commit per range, so the
+# services' own writes are never blocked for long
+BACKFILL_CHUNK_SIZE = 10000
+
+###########################################################################
+##	
+##	Fills in item_name for rows of table that don't have one yet, using the
+##	product names in the attached items.db.  Rows whose item no longer
+##	exists are left NULL.  Returns the number of rows updated.
+##	
+###########################################################################
+def BackfillTable(conn, table: str) -> int:
+	cursor = conn.cursor()
+	
+	cursor.execute(f'SELECT MAX(rowid) FROM {table}')
+	maxRowId = cursor.fetchone()[0] or 0
+	
+	rowsUpdated = 0
+	for start in range(0, maxRowId, BACKFILL_CHUNK_SIZE):
+		cursor.execute(f'UPDATE {table} SET item_name = (SELECT product_name FROM items_db.items WHERE items_db.items.id = {table}.item_id) ' \
+			'WHERE rowid > ? AND rowid <= ? AND item_name IS NULL', (start, start + BACKFILL_CHUNK_SIZE,))
+		rowsUpdated += cursor.rowcount
+		conn.commit()
+	
+	return rowsUpdated
+
+def BackfillDb(dbPath: str, itemsDbPath: str, table: str) -> None:
+	if os.path.exists(dbPath) == False:
+		return
+	
+	conn = sqlite3.connect(dbPath)
+	conn.execute('ATTACH DATABASE ? AS items_db', (itemsDbPath,))
+	
+	rowsUpdated = BackfillTable(conn, table)
+	print(f'{dbPath}: updated item_name on {rowsUpdated} {table} rows')
+	
+	conn.close()
+	
+	return
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--db-directory', dest='db_directory', required=True)
+	args = parser.parse_args()
+	
+	itemsDbPath = os.path.join(args.db_directory, 'items.db')
+	
+	BackfillDb(os.path.join(args.db_directory, 'orders.db'), itemsDbPath, 'order_items')
+	BackfillDb(os.path.join(args.db_directory, 'shopping_carts.db'), itemsDbPath, 'shopping_cart_items')
+	
+	return
+
+if __name__ == '__main__':
+	main()
@@ -1,4 +1,5 @@
 import argparse
+import datetime
 import os
 import sqlite3
 
@@ -26,8 +27,45 @@ def CreateOrderDb(dbDirectory, removeExisting):
 		'order_id INTEGER,' \
 		'item_id INTEGER,' \
 		'quantity INTEGER,'
-		'price DECIMAL)')#,' \
-		# 'price DECIMAL)')
+		'price DECIMAL,' \
+		'item_name TEXT)')
+	
+	CreateOrderOutboxTable(cursor)
+	CreateOrderItemsIndexes(cursor)
+	CreateItemOrdersTable(cursor)
+	conn.commit()
+
+###########################################################################
+##	
+##	Events written in the same transaction as the order they're about,
+##	published to rabbitmq and deleted by the orders service's outbox
+##	publisher
+##	
+###########################################################################
+def CreateOrderOutboxTable(cursor):
+	cursor.execute('CREATE TABLE IF NOT EXISTS order_outbox(' \
+		'id INTEGER PRIMARY KEY AUTOINCREMENT,' \
+		'routing_key TEXT,' \
+		'body TEXT,' \
+		'created_at TIMESTAMP)')
+
+def CreateOrderItemsIndexes(cursor):
+	cursor.execute('CREATE INDEX IF NOT EXISTS order_items_order_id_idx ON order_items(order_id)')
+
+###########################################################################
+##	
+##	Purchased orders by the items in them, one row per item and order.
+##	Written by the orders service in the same transaction that marks an
+##	order purchased.
+##	
+###########################################################################
+def CreateItemOrdersTable(cursor):
+	cursor.execute('CREATE TABLE IF NOT EXISTS item_orders(' \
+		'item_id INTEGER,' \
+		'order_id INTEGER,' \
+		'user_id INTEGER,' \
+		'PRIMARY KEY(item_id, order_id)) WITHOUT ROWID')
+	cursor.execute('CREATE INDEX IF NOT EXISTS item_orders_user_id_idx ON item_orders(item_id, user_id, order_id)')
 
 def CreateUserDb(dbDirectory, removeExisting):
 	dbPath = os.path.join(dbDirectory, 'users.db')
@@ -51,6 +89,52 @@ def CreateUserDb(dbDirectory, removeExisting):
 		'address TEXT,' \
 		'phone TEXT,' \
 		'credit_card TEXT)')
+	
+	# emails are unique and looked up on every orders service request
+	cursor.execute('CREATE UNIQUE INDEX users_email_idx ON users(email)')
+	CreateUserLookupIndexes(cursor)
+
+###########################################################################
+##	
+##	Indexes for last name searches and for joining profiles onto users
+##	
+###########################################################################
+def CreateUserLookupIndexes(cursor):
+	cursor.execute('CREATE INDEX IF NOT EXISTS users_last_name_idx ON users(last_name)')
+	cursor.execute('CREATE INDEX IF NOT EXISTS user_profiles_user_id_idx ON user_profiles(user_id)')
+
+###########################################################################
+##	
+##	Brings an existing users.db up to the current schema.  If emails are
+##	already duplicated they're listed and email lookups get a plain index
+##	until they're fixed by hand, the next --migrate after that makes it
+##	unique.
+##	
+###########################################################################
+def MigrateUserDb(dbDirectory):
+	dbPath = os.path.join(dbDirectory, 'users.db')
+	
+	if os.path.exists(dbPath) == False:
+		return
+	
+	conn = sqlite3.connect(dbPath)
+	cursor = conn.cursor()
+	
+	CreateUserLookupIndexes(cursor)
+	
+	cursor.execute('SELECT email, COUNT(*) FROM users GROUP BY email HAVING COUNT(*) > 1')
+	duplicateEmails = cursor.fetchall()
+	
+	if len(duplicateEmails) > 0:
+		for email, count in duplicateEmails:
+			print(f'{dbPath}: email {email} is used by {count} users')
+		print(f'{dbPath}: users.email index is not unique until duplicates are removed')
+	
+	CreateLookupIndex(cursor, 'users_email_idx', 'users', 'email', len(duplicateEmails) == 0)
+	
+	conn.commit()
+	
+	return
 
 def CreateItemDb(dbDirectory, removeExisting):
 	dbPath = os.path.join(dbDirectory, 'items.db')
@@ -66,7 +150,170 @@ def CreateItemDb(dbDirectory, removeExisting):
 		'product_name TEXT,' \
 		'description TEXT,' \
 		'price DECIMAL,' \
-		'quantity_in_stock INTEGER)')
+		'quantity_in_stock INTEGER,' \
+		'stock_shards INTEGER DEFAULT 0,' \
+		'updated_at TIMESTAMP)')
+	
+	# product names are looked up on every cart add, so they need a unique index
+	cursor.execute('CREATE UNIQUE INDEX items_product_name_idx ON items(product_name)')
+	
+	CreateItemExportIndexes(cursor)
+	
+	CreateItemStockShardsTable(cursor)
+	CreateProcessedOrdersTable(cursor)
+	CreateItemSearchIndex(cursor)
+	conn.commit()
+
+###########################################################################
+##	
+##	Full text index over items.product_name and items.description.  It's an
+##	external content table, so the text itself is only stored in items, and
+##	triggers keep it in sync with inserts, deletes and renames.  Stock
+##	updates don't touch the indexed columns and skip the triggers.
+##	
+###########################################################################
+def CreateItemSearchIndex(cursor):
+	cursor.execute("CREATE VIRTUAL TABLE items_fts USING fts5(product_name, description, content='items', content_rowid='id')")
+	
+	# matches in the product name count for more than matches in the description
+	cursor.execute("INSERT INTO items_fts(items_fts, rank) VALUES('rank', 'bm25(10.0, 1.0)')")
+	
+	cursor.execute('CREATE TRIGGER items_fts_insert AFTER INSERT ON items BEGIN ' \
+		'INSERT INTO items_fts(rowid, product_name, description) VALUES (new.id, new.product_name, new.description); ' \
+		'END')
+	cursor.execute('CREATE TRIGGER items_fts_delete AFTER DELETE ON items BEGIN ' \
+		"INSERT INTO items_fts(items_fts, rowid, product_name, description) VALUES ('delete', old.id, old.product_name, old.description); " \
+		'END')
+	cursor.execute('CREATE TRIGGER items_fts_update AFTER UPDATE OF product_name, description ON items BEGIN ' \
+		"INSERT INTO items_fts(items_fts, rowid, product_name, description) VALUES ('delete', old.id, old.product_name, old.description); " \
+		'INSERT INTO items_fts(rowid, product_name, description) VALUES (new.id, new.product_name, new.description); ' \
+		'END')
+
+###########################################################################
+##	
+##	Indexes behind the catalog export, incremental exports walk items in
+##	(updated_at, id) order and always include the few sharded items, whose
+##	stock changes without touching their items row
+##	
+###########################################################################
+def CreateItemExportIndexes(cursor):
+	cursor.execute('CREATE INDEX IF NOT EXISTS items_updated_at_idx ON items(updated_at, id)')
+	cursor.execute('CREATE INDEX IF NOT EXISTS items_sharded_idx ON items(id) WHERE stock_shards > 0')
+
+def TableExists(cursor, table) -> bool:
+	cursor.execute('SELECT 1 FROM sqlite_master WHERE name = ?', (table,))
+	
+	return cursor.fetchone() != None
+
+###########################################################################
+##	
+##	Stock for items in sharded mode (items.stock_shards > 0) is split over
+##	stock_shards rows in this table instead of items.quantity_in_stock
+##	
+###########################################################################
+def CreateItemStockShardsTable(cursor):
+	cursor.execute('CREATE TABLE IF NOT EXISTS item_stock_shards(' \
+		'item_id INTEGER,' \
+		'shard INTEGER,' \
+		'quantity INTEGER,' \
+		'PRIMARY KEY(item_id, shard)) WITHOUT ROWID')
+
+###########################################################################
+##	
+##	Orders the items service has taken stock for or failed, with the event
+##	it published for each.  Written in the same transaction as the stock
+##	change, so a redelivered order is answered with the stored event
+##	instead of being decremented twice.
+##	
+###########################################################################
+def CreateProcessedOrdersTable(cursor):
+	cursor.execute('CREATE TABLE IF NOT EXISTS processed_orders(' \
+		'order_id INTEGER PRIMARY KEY,' \
+		'routing_key TEXT,' \
+		'body TEXT)')
+
+###########################################################################
+##	
+##	Creates a single column lookup index, unique or not.  A plain index
+##	left behind while its column still had duplicates is rebuilt as unique
+##	once they're gone.
+##	
+###########################################################################
+def CreateLookupIndex(cursor, indexName, table, column, unique) -> None:
+	cursor.execute(f'PRAGMA index_list({table})')
+	existingUnique = {row[1]: row[2] == 1 for row in cursor.fetchall()}.get(indexName)
+	
+	if existingUnique == unique:
+		return
+	
+	if existingUnique == False:
+		cursor.execute(f'DROP INDEX {indexName}')
+	
+	if unique == True:
+		cursor.execute(f'CREATE UNIQUE INDEX {indexName} ON {table}({column})')
+	else:
+		cursor.execute(f'CREATE INDEX {indexName} ON {table}({column})')
+	
+	return
+
+def ColumnExists(cursor, table, column) -> bool:
+	cursor.execute(f'PRAGMA table_info({table})')
+	
+	return column in [row[1] for row in cursor.fetchall()]
+
+###########################################################################
+##	
+##	Brings an existing items.db up to the current schema.  Orders and carts
+##	in the other dbs refer to items by id, so like duplicate emails in
+##	MigrateUserDb, duplicate product names are only listed and name lookups
+##	get a plain index until they're fixed by hand.  The next --migrate
+##	after that makes it unique.
+##	
+###########################################################################
+def MigrateItemDb(dbDirectory):
+	dbPath = os.path.join(dbDirectory, 'items.db')
+	
+	if os.path.exists(dbPath) == False:
+		return
+	
+	conn = sqlite3.connect(dbPath)
+	cursor = conn.cursor()
+	
+	cursor.execute('SELECT product_name, GROUP_CONCAT(id) FROM items GROUP BY product_name HAVING COUNT(*) > 1')
+	duplicateNames = cursor.fetchall()
+	
+	if len(duplicateNames) > 0:
+		for productName, itemIds in duplicateNames:
+			print(f'{dbPath}: product name {productName} is used by items {itemIds}')
+		print(f'{dbPath}: items.product_name index is not unique until duplicates are removed')
+	
+	CreateLookupIndex(cursor, 'items_product_name_idx', 'items', 'product_name', len(duplicateNames) == 0)
+	conn.commit()
+	
+	# sharded stock counters
+	if ColumnExists(cursor, 'items', 'stock_shards') == False:
+		cursor.execute('ALTER TABLE items ADD COLUMN stock_shards INTEGER DEFAULT 0')
+	CreateItemStockShardsTable(cursor)
+	conn.commit()
+	
+	# orders already processed, so redelivered ones aren't decremented twice
+	CreateProcessedOrdersTable(cursor)
+	conn.commit()
+	
+	# updated_at for incremental catalog exports, existing rows count as updated now
+	if ColumnExists(cursor, 'items', 'updated_at') == False:
+		cursor.execute('ALTER TABLE items ADD COLUMN updated_at TIMESTAMP')
+		cursor.execute('UPDATE items SET updated_at = ?', (str(datetime.datetime.now()),))
+	CreateItemExportIndexes(cursor)
+	conn.commit()
+	
+	# full text search, built from the rows already in items
+	if TableExists(cursor, 'items_fts') == False:
+		CreateItemSearchIndex(cursor)
+		cursor.execute("INSERT INTO items_fts(items_fts) VALUES('rebuild')")
+		conn.commit()
+	
+	return
 
 def CreateShoppingCartDb(dbDirectory, removeExisting):
 	dbPath = os.path.join(dbDirectory, 'shopping_carts.db')
@@ -80,20 +327,105 @@ def CreateShoppingCartDb(dbDirectory, removeExisting):
 	cursor.execute('CREATE TABLE shopping_carts(' \
 		'id INTEGER PRIMARY KEY AUTOINCREMENT,' \
 		'user_id INTEGER,' \
-		'status TEXT)')
+		'status TEXT,' \
+		'order_id INTEGER)')
+	
+	CreateShoppingCartOrderIndex(cursor)
 	
 	cursor.execute('CREATE TABLE shopping_cart_items(' \
 		'cart_id INTEGER,' \
 		'item_id INTEGER,' \
 		'quantity INTEGER,' \
-		'price DECIMAL)')
+		'price DECIMAL,' \
+		'item_name TEXT)')
+
+###########################################################################
+##	
+##	A closed cart keeps the id of the order it was closed for, the shopping
+##	cart service looks it up there when an order created event is redelivered
+##	
+###########################################################################
+def CreateShoppingCartOrderIndex(cursor):
+	cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS shopping_carts_order_id_idx ON shopping_carts(order_id)')
+
+###########################################################################
+##	
+##	Adds the item_name column that order_items rows keep the item's name
+##	in as of purchase time, the order_outbox table, and the item_orders
+##	index of purchased orders, filled from existing orders.  Run
+##	backfill_item_names.py afterwards to fill in names for existing rows.
+##	
+###########################################################################
+def MigrateOrderDb(dbDirectory):
+	dbPath = os.path.join(dbDirectory, 'orders.db')
+	
+	if os.path.exists(dbPath) == False:
+		return
+	
+	conn = sqlite3.connect(dbPath)
+	cursor = conn.cursor()
+	
+	if ColumnExists(cursor, 'order_items', 'item_name') == False:
+		cursor.execute('ALTER TABLE order_items ADD COLUMN item_name TEXT')
+	
+	CreateOrderOutboxTable(cursor)
+	CreateOrderItemsIndexes(cursor)
+	
+	# index every order purchased before item_orders existed
+	if TableExists(cursor, 'item_orders') == False:
+		CreateItemOrdersTable(cursor)
+		cursor.execute('INSERT OR IGNORE INTO item_orders(item_id, order_id, user_id) ' \
+			'SELECT order_items.item_id, orders.id, orders.user_id FROM orders JOIN order_items ON order_items.order_id = orders.id ' \
+			'WHERE orders.status = ?', ('purchased',))
+		print(f'indexed {cursor.rowcount} purchased order items in {dbPath}')
+	
+	conn.commit()
+	
+	return
+
+###########################################################################
+##	
+##	Adds the item_name column to shopping_cart_items, filled in when an
+##	item is added to a cart, and the order_id column to shopping_carts,
+##	filled in when a cart is closed for an order
+##	
+###########################################################################
+def MigrateShoppingCartDb(dbDirectory):
+	dbPath = os.path.join(dbDirectory, 'shopping_carts.db')
+	
+	if os.path.exists(dbPath) == False:
+		return
+	
+	conn = sqlite3.connect(dbPath)
+	cursor = conn.cursor()
+	
+	if ColumnExists(cursor, 'shopping_cart_items', 'item_name') == False:
+		cursor.execute('ALTER TABLE shopping_cart_items ADD COLUMN item_name TEXT')
+	
+	if ColumnExists(cursor, 'shopping_carts', 'order_id') == False:
+		cursor.execute('ALTER TABLE shopping_carts ADD COLUMN order_id INTEGER')
+	
+	CreateShoppingCartOrderIndex(cursor)
+	
+	conn.commit()
+	
+	return
 
 def main():
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--db-directory', dest='db_directory', required=True)
 	parser.add_argument('-r', action='store_true', dest='remove_existing', required=False)
+	parser.add_argument('--migrate', action='store_true', dest='migrate', required=False)
 	args = parser.parse_args()
 	
+	# migrate existing databases in place instead of creating new ones
+	if args.migrate == True:
+		MigrateUserDb(dbDirectory=args.db_directory)
+		MigrateItemDb(dbDirectory=args.db_directory)
+		MigrateOrderDb(dbDirectory=args.db_directory)
+		MigrateShoppingCartDb(dbDirectory=args.db_directory)
+		return
+	
 	# CreateOrderDb(dbDirectory=args.db_directory, removeExisting=args.remove_existing)
 	# CreateUserDb(dbDirectory=args.db_directory, removeExisting=args.remove_existing)
 	# CreateItemDb(dbDirectory=args.db_directory, removeExisting=args.remove_existing)
@@ -1,5 +1,6 @@
 import argparse
 import csv
+import datetime
 import os
 import random
 import sqlite3
@@ -13,6 +14,7 @@ def ItemsCsvToDb(dbDirectory, csvPath):
 		reader = csv.reader(file, delimiter=',', quotechar='"')
 		rowsToInsert = []
 		counter = 0
+		currTimeStr = str(datetime.datetime.now())
 		for row in reader:
 			if isFirst == True:
 				isFirst = False
@@ -22,10 +24,15 @@ def ItemsCsvToDb(dbDirectory, csvPath):
 			if row[6] == '':
 				continue
 			
-			rowsToInsert.append((row[3], row[10], int(row[6]) / 100, counter + 100))
+			rowsToInsert.append((row[3], row[10], int(row[6]) / 100, counter + 100, currTimeStr))
 			counter += 1
 	
-	cursor.executemany('INSERT INTO items(product_name, description, price, quantity_in_stock) VALUES(?, ?, ?, ?)', rowsToInsert)
+	# product names are unique, the first row seen for a name wins
+	cursor.executemany('INSERT OR IGNORE INTO items(product_name, description, price, quantity_in_stock, updated_at) VALUES(?, ?, ?, ?, ?)', rowsToInsert)
+	conn.commit()
+	
+	# the insert trigger filled the search index row by row, merge it down now that the load is done
+	cursor.execute("INSERT INTO items_fts(items_fts) VALUES('optimize')")
 	conn.commit()
 	
 	return
@@ -30,7 +30,8 @@ def main():
 		
 		rowsToInsert.append((tempEmail, tempFirstName, tempLastName, tempCreatedAt, tempCreatedAt))
 	
-	cursor.executemany('INSERT INTO users(email, first_name, last_name, created_at, updated_at) VALUES(?, ?, ?, ?, ?)', rowsToInsert)
+	# emails are unique, skip generated names that collide with an existing email
+	cursor.executemany('INSERT OR IGNORE INTO users(email, first_name, last_name, created_at, updated_at) VALUES(?, ?, ?, ?, ?)', rowsToInsert)
 	conn.commit()
 	
 	return
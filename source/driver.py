@@ -6,6 +6,7 @@ import time
 # constants
 JSON_HEADER_DATATYPE		= {'Content-type': 'application/json'}
 ORDER_SERVICE_PROT			= 5000
+ORDER_STATUS_SERVICE_PORT	= 5001
 SHOPPING_CART_SERVICE_PORT	= 6000
 USERS_SERVICE_PORT			= 7000
 ITEMS_SERVICE_PORT			= 8000
@@ -14,18 +15,25 @@ TEST_ITEM_NAMES				= ['Zed Loafers', 'AW Bellies', 'Ladela Bellies', "Oye Boy's
 TEST_ITEM_QUANTITIES		= [] # auto populated in script
 
 def PollForOrderStatus(orderId: int, status: str) -> None:
-	url = f'http://127.0.0.1:{ORDER_SERVICE_PROT}/get_order_status'
+	url = f'http://127.0.0.1:{ORDER_STATUS_SERVICE_PORT}/wait_order_status'
+	seenStatus = 'pending'
 	
+	# each request returns as soon as the status changes from the last one seen
 	while True:
-		resp = requests.get(url=url, data=json.dumps({'order_id': orderId}), headers=JSON_HEADER_DATATYPE)#, timeout=1)
+		resp = requests.get(url=url, data=json.dumps({'order_id': orderId, 'seen_status': seenStatus}), headers=JSON_HEADER_DATATYPE)
+		
+		# too many waiters, back off like the old polling loop did
+		if resp.status_code == 503:
+			time.sleep(1)
+			continue
+		
 		assert resp.status_code == 200
 		
 		respJson = resp.json()
 		if respJson['order_status'] == status:
 			break
 		
-		# only poll once a second to be reasonable
-		time.sleep(1)
+		seenStatus = respJson['order_status']
 	
 	return
 
@@ -0,0 +1,250 @@
+from concurrent.futures import ThreadPoolExecutor
+from create_dbs.create_dbs import CreateItemDb
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+# the items service is a standalone script, import it straight from its directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'services', 'items'))
+import items
+
+DEFAULT_CATALOG_SIZES	= [10000, 100000, 1000000]
+DEFAULT_CONCURRENCY		= [1, 4, 16]
+GENERATE_CHUNK_SIZE		= 10000
+
+###########################################################################
+##	
+##	Stands in for the RabbitMQ consumer channel and the rmq_producer,
+##	counts what the order callback publishes and acks.  Published events
+##	come back already confirmed.
+##	
+###########################################################################
+class CountingChannel:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.published = {}
+		self.acks = 0
+	
+	def Publish(self, routingKey, body, onConfirm=None):
+		with self.lock:
+			self.published[routingKey] = self.published.get(routingKey, 0) + 1
+		
+		ticket = {'routing_key': routingKey, 'body': body, 'on_confirm': onConfirm, 'queued_at': time.perf_counter(), 'confirmed': threading.Event()}
+		ticket['confirmed'].set()
+		
+		return ticket
+	
+	def basic_ack(self, delivery_tag, multiple=False):
+		with self.lock:
+			self.acks += 1
+
+class BenchmarkDelivery:
+	def __init__(self, deliveryTag: int):
+		self.delivery_tag = deliveryTag
+
+###########################################################################
+##	
+##	Creates an items.db with catalogSize synthetic items, inserted in
+##	chunks so generating large catalogs doesn't hold them all in memory
+##	
+###########################################################################
+def GenerateCatalog(dbDirectory: str, catalogSize: int) -> str:
+	CreateItemDb(dbDirectory=dbDirectory, removeExisting=True)
+	
+	dbPath = os.path.join(dbDirectory, 'items.db')
+	conn = sqlite3.connect(dbPath)
+	cursor = conn.cursor()
+	
+	currTimeStr = str(datetime.datetime.now())
+	for start in range(0, catalogSize, GENERATE_CHUNK_SIZE):
+		rowsToInsert = []
+		for itemNumber in range(start, min(start + GENERATE_CHUNK_SIZE, catalogSize)):
+			rowsToInsert.append((f'Benchmark Item {itemNumber}', f'synthetic item number {itemNumber} for benchmarking', random.randint(100, 10000) / 100, 1000000000, currTimeStr))
+		
+		cursor.executemany('INSERT INTO items(product_name, description, price, quantity_in_stock, updated_at) VALUES(?, ?, ?, ?, ?)', rowsToInsert)
+		conn.commit()
+	
+	cursor.execute("INSERT INTO items_fts(items_fts) VALUES('optimize')")
+	conn.commit()
+	conn.close()
+	
+	return dbPath
+
+def Percentile(sortedValues, percent: float) -> float:
+	if len(sortedValues) == 0:
+		return 0.0
+	
+	index = min(int(round(percent / 100 * (len(sortedValues) - 1))), len(sortedValues) - 1)
+	
+	return sortedValues[index]
+
+###########################################################################
+##	
+##	Builds a result record from per-operation latencies in seconds
+##	
+###########################################################################
+def SummarizeLatencies(benchmark: str, catalogSize: int, concurrency: int, latencies, elapsedSeconds: float, extra=None):
+	sortedLatencies = sorted(latencies)
+	
+	result = {
+		'benchmark': benchmark,
+		'catalog_size': catalogSize,
+		'concurrency': concurrency,
+		'ops': len(latencies),
+		'seconds': elapsedSeconds,
+		'ops_per_sec': len(latencies) / elapsedSeconds if elapsedSeconds > 0 else 0.0,
+		'p50_ms': Percentile(sortedLatencies, 50) * 1000,
+		'p95_ms': Percentile(sortedLatencies, 95) * 1000,
+		'p99_ms': Percentile(sortedLatencies, 99) * 1000
+	}
+	
+	if extra != None:
+		result.update(extra)
+	
+	return result
+
+###########################################################################
+##	
+##	Drives /get_item_info through the flask test client from concurrency
+##	threads, looking items up by a random mix of id and name
+##	
+###########################################################################
+def BenchmarkGetItemInfo(catalogSize: int, concurrency: int, numRequests: int):
+	requestsPerWorker = max(numRequests // concurrency, 1)
+	
+	def Worker(seed: int):
+		workerRandom = random.Random(seed)
+		client = items.app.test_client()
+		latencies = []
+		
+		for _ in range(requestsPerWorker):
+			itemNumber = workerRandom.randrange(catalogSize)
+			if workerRandom.random() < 0.5:
+				reqData = {'item_id': itemNumber + 1}
+			else:
+				reqData = {'item_name': f'Benchmark Item {itemNumber}'}
+			
+			startTime = time.perf_counter()
+			resp = client.get('/get_item_info', json=reqData)
+			latencies.append(time.perf_counter() - startTime)
+			
+			assert resp.status_code == 200
+		
+		return latencies
+	
+	cacheHitsBefore = items.itemCacheHits
+	cacheMissesBefore = items.itemCacheMisses
+	
+	startTime = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		workerLatencies = list(executor.map(Worker, range(concurrency)))
+	elapsedSeconds = time.perf_counter() - startTime
+	
+	latencies = [latency for workerResult in workerLatencies for latency in workerResult]
+	extra = {
+		'cache_hits': items.itemCacheHits - cacheHitsBefore,
+		'cache_misses': items.itemCacheMisses - cacheMissesBefore
+	}
+	
+	return SummarizeLatencies('get_item_info', catalogSize, concurrency, latencies, elapsedSeconds, extra)
+
+###########################################################################
+##	
+##	Feeds synthetic ShoppingCartValidatedQueue payloads straight to the
+##	order callback in batches of batchSize, timing each order
+##	
+###########################################################################
+def BenchmarkValidateOrders(catalogSize: int, firstOrderId: int, numOrders: int, itemsPerOrder: int, batchSize: int):
+	channel = CountingChannel()
+	items.rmq_producer.Publish = channel.Publish
+	
+	deliveryTag = 0
+	latencies = []
+	
+	startTime = time.perf_counter()
+	for start in range(0, numOrders, batchSize):
+		messages = []
+		for orderId in range(firstOrderId + start, firstOrderId + min(start + batchSize, numOrders)):
+			deliveryTag += 1
+			orderItems = [{'item_id': random.randrange(catalogSize) + 1, 'item_quantity': random.randint(1, 5), 'item_price': 1.0} for _ in range(itemsPerOrder)]
+			eventData = {'user_id': 1, 'order_id': orderId, 'items': orderItems}
+			messages.append((BenchmarkDelivery(deliveryTag), None, json.dumps(eventData).encode('utf-8')))
+		
+		batchStartTime = time.perf_counter()
+		items.RmqOrderCreatedBatchCallback(channel, messages)
+		batchLatency = time.perf_counter() - batchStartTime
+		
+		# every order in a batch completes when the batch commits
+		latencies.extend([batchLatency] * len(messages))
+	elapsedSeconds = time.perf_counter() - startTime
+	
+	extra = {
+		'batch_size': batchSize,
+		'items_per_order': itemsPerOrder,
+		'validated': channel.published.get('OrderItemsValidatedQueue', 0),
+		'failed': channel.published.get('OrderFailedQueue', 0)
+	}
+	
+	return SummarizeLatencies('validate_orders', catalogSize, 1, latencies, elapsedSeconds, extra)
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--catalog-sizes', dest='catalog_sizes', type=int, nargs='+', default=DEFAULT_CATALOG_SIZES)
+	parser.add_argument('--concurrency', dest='concurrency', type=int, nargs='+', default=DEFAULT_CONCURRENCY)
+	parser.add_argument('--requests', dest='requests', type=int, default=20000)
+	parser.add_argument('--orders', dest='orders', type=int, default=5000)
+	parser.add_argument('--items-per-order', dest='items_per_order', type=int, default=4)
+	parser.add_argument('--batch-sizes', dest='batch_sizes', type=int, nargs='+', default=[1, 32])
+	parser.add_argument('--work-directory', dest='work_directory', required=False)
+	parser.add_argument('--output', dest='output', default='items_benchmark_results.json')
+	args = parser.parse_args()
+	
+	workDirectory = args.work_directory or tempfile.mkdtemp(prefix='items_benchmark_')
+	os.makedirs(workDirectory, exist_ok=True)
+	
+	# order ids are never reused, the items service would take a repeated one
+	# for a redelivery and skip its stock updates
+	nextOrderId = 1
+	
+	results = []
+	for catalogSize in args.catalog_sizes:
+		print(time.strftime('%H:%M:%S'), f'generating catalog of {catalogSize} items in {workDirectory}')
+		dbPath = GenerateCatalog(workDirectory, catalogSize)
+		items.ItemsDbInit(dbPath)
+		
+		for concurrency in args.concurrency:
+			result = BenchmarkGetItemInfo(catalogSize, concurrency, args.requests)
+			print(time.strftime('%H:%M:%S'), json.dumps(result))
+			results.append(result)
+		
+		for batchSize in args.batch_sizes:
+			result = BenchmarkValidateOrders(catalogSize, nextOrderId, args.orders, args.items_per_order, batchSize)
+			nextOrderId += args.orders
+			print(time.strftime('%H:%M:%S'), json.dumps(result))
+			results.append(result)
+	
+	output = {
+		'generated_at': str(datetime.datetime.now()),
+		'python_version': platform.python_version(),
+		'sqlite_version': sqlite3.sqlite_version,
+		'platform': platform.platform(),
+		'results': results
+	}
+	
+	with open(args.output, 'w') as file:
+		json.dump(output, file, indent='\t')
+	
+	print(f'wrote {len(results)} results to {args.output}')
+	
+	return
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,175 @@
+import contextlib
+import queue
+import sqlite3
+import threading
+import time
+
+###########################################################################
+##	
+##	Shared sqlite read connection pool.  Each service reads one db, so the
+##	pool is module state set up by PoolInit().  Connections are opened
+##	lazily up to the pool size, opened read only, and each one is checked
+##	out by one thread at a time.  Writes don't go through the pool, every
+##	service keeps its own single writer connection under its dbLock.
+##	
+###########################################################################
+
+# IN lists are split into chunks of this many values, sqlite builds older
+# than 3.32 refuse statements with more than 999 bound parameters
+MAX_SQL_VARIABLES = 999
+
+dbPath = None
+poolSize = 0
+
+dbReadPool = queue.LifoQueue()
+dbReadPoolLock = threading.Lock()
+dbReadConnectionsOpen = 0
+
+# bumped by PoolInit, connections opened for an older db are closed when
+# they're returned instead of going back in the pool
+poolGeneration = 0
+
+dbPoolStats = {
+	'read_acquires': 0,
+	'read_waits': 0,
+	'read_wait_seconds': 0.0,
+	'read_max_wait_seconds': 0.0,
+	'write_acquires': 0,
+	'write_wait_seconds': 0.0,
+	'write_max_wait_seconds': 0.0
+}
+
+###########################################################################
+##	
+##	Points the pool at the given db, closing the idle connections to any
+##	previously opened one
+##	
+###########################################################################
+def PoolInit(path: str, size: int) -> None:
+	global dbPath
+	global poolSize
+	global dbReadConnectionsOpen
+	global poolGeneration
+	
+	with dbReadPoolLock:
+		dbPath = path
+		poolSize = size
+		poolGeneration += 1
+		
+		while dbReadPool.empty() == False:
+			dbReadPool.get_nowait()[0].close()
+		dbReadConnectionsOpen = 0
+	
+	return
+
+###########################################################################
+##	
+##	Records how long a thread waited for a connection, kind is read or write
+##	
+###########################################################################
+def RecordWait(kind: str, waitSeconds: float) -> None:
+	with dbReadPoolLock:
+		dbPoolStats[f'{kind}_acquires'] += 1
+		dbPoolStats[f'{kind}_wait_seconds'] += waitSeconds
+		dbPoolStats[f'{kind}_max_wait_seconds'] = max(dbPoolStats[f'{kind}_max_wait_seconds'], waitSeconds)
+	
+	return
+
+###########################################################################
+##	
+##	Opens a service's single writer connection.  The db is switched to WAL
+##	so the pooled readers keep running while the writer has a transaction
+##	open, with the default rollback journal they'd block on its lock.
+##	
+###########################################################################
+def OpenWriteConnection(path: str):
+	# check_same_thread = False means the write operations aren't thread safe, callers serialize them with their dbLock
+	conn = sqlite3.connect(database=path, check_same_thread=False)
+	
+	try:
+		conn.execute('PRAGMA journal_mode=WAL').fetchall()
+	except Exception:
+		conn.close()
+		raise
+	
+	return conn
+
+def OpenReadConnection():
+	# connections move between threads, but only one thread uses one at a time
+	conn = sqlite3.connect(database=dbPath, check_same_thread=False)
+	
+	try:
+		conn.execute('PRAGMA query_only=1')
+	except Exception:
+		conn.close()
+		raise
+	
+	return conn
+
+###########################################################################
+##	
+##	Checks a read cursor out of the pool for the duration of the with
+##	block.  Opens a new connection if the pool is empty and under the pool
+##	size, otherwise waits for another thread to return one.
+##	
+###########################################################################
+@contextlib.contextmanager
+def ReadCursor():
+	global dbReadConnectionsOpen
+	
+	startTime = time.monotonic()
+	
+	try:
+		conn, generation = dbReadPool.get_nowait()
+	except queue.Empty:
+		with dbReadPoolLock:
+			generation = poolGeneration
+			if dbReadConnectionsOpen < poolSize:
+				dbReadConnectionsOpen += 1
+				openNew = True
+			else:
+				dbPoolStats['read_waits'] += 1
+				openNew = False
+		
+		if openNew == True:
+			try:
+				conn = OpenReadConnection()
+			except Exception:
+				# give the slot back, or enough failed opens would leave every reader waiting forever
+				with dbReadPoolLock:
+					if generation == poolGeneration:
+						dbReadConnectionsOpen -= 1
+				raise
+		else:
+			conn, generation = dbReadPool.get()
+	
+	RecordWait('read', time.monotonic() - startTime)
+	
+	cursor = conn.cursor()
+	try:
+		yield cursor
+	finally:
+		cursor.close()
+		
+		with dbReadPoolLock:
+			current = generation == poolGeneration
+		
+		if current == True:
+			dbReadPool.put((conn, generation))
+		else:
+			conn.close()
+
+###########################################################################
+##	
+##	Returns pool size and connection wait time metrics
+##	
+###########################################################################
+def GetPoolStats():
+	with dbReadPoolLock:
+		stats = dict(dbPoolStats)
+		stats['read_pool_size'] = poolSize
+		stats['read_connections_open'] = dbReadConnectionsOpen
+	
+	stats['read_connections_idle'] = dbReadPool.qsize()
+	
+	return stats
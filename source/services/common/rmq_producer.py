@@ -0,0 +1,313 @@
+import collections
+import logging
+import os
+import pika
+import threading
+import time
+
+###########################################################################
+##	
+##	Shared RabbitMQ producer with publisher confirms.  One SelectConnection
+##	per service runs on its own thread.  Publish() can be called from any
+##	thread: it queues the message and returns a ticket right away.  The
+##	connection thread sends queued messages in batches, once
+##	RMQ_PRODUCER_BATCH_SIZE are waiting or RMQ_PRODUCER_FLUSH_MS after the
+##	first one was queued, and tracks the broker's confirms asynchronously.
+##	Nacked messages, and messages still unconfirmed when the connection
+##	drops, are published again, so every ticket is eventually confirmed.
+##	
+###########################################################################
+
+PRODUCER_BATCH_SIZE			= int(os.environ.get('RMQ_PRODUCER_BATCH_SIZE', '100'))
+PRODUCER_FLUSH_MS			= float(os.environ.get('RMQ_PRODUCER_FLUSH_MS', '5'))
+PRODUCER_RECONNECT_SECS		= 5
+
+logger = logging.getLogger(__name__)
+
+# queues declared on every (re)connect
+declaredQueues = []
+
+# messages waiting to be published, and published messages waiting for a
+# confirm by delivery tag.  Both are only changed under producerLock.
+producerLock = threading.Lock()
+pendingMessages = collections.deque()
+unconfirmedMessages = {}
+nextDeliveryTag = 0
+
+# connection state, the connection and channel are only used on the producer thread
+producerConnection = None
+producerChannel = None
+producerReady = False
+flushScheduled = False
+
+producerStats = {
+	'published': 0,
+	'confirmed': 0,
+	'nacked': 0,
+	'republished': 0,
+	'confirm_seconds': 0.0,
+	'max_confirm_seconds': 0.0
+}
+
+###########################################################################
+##	
+##	Starts the producer thread, connecting to amqpUrl and declaring queues
+##	
+###########################################################################
+def ProducerInit(amqpUrl: str, queues) -> None:
+	declaredQueues.extend(queues)
+	
+	producerThread = threading.Thread(target=RunProducer, args=(amqpUrl,), daemon=True)
+	producerThread.start()
+	
+	return
+
+def RunProducer(amqpUrl: str) -> None:
+	global producerConnection
+	
+	urlParams = pika.URLParameters(amqpUrl)
+	
+	while True:
+		try:
+			producerConnection = pika.SelectConnection(urlParams,
+													   on_open_callback=OnConnectionOpen,
+													   on_open_error_callback=OnConnectionOpenError,
+													   on_close_callback=OnConnectionClosed)
+			producerConnection.ioloop.start()
+		except Exception:
+			logger.exception('RabbitMQ producer stopped unexpectedly')
+		
+		time.sleep(PRODUCER_RECONNECT_SECS)
+	
+	return
+
+def OnConnectionOpen(connection) -> None:
+	logger.info('Producer connected to RabbitMQ')
+	connection.channel(on_open_callback=OnChannelOpen)
+	
+	return
+
+def OnConnectionOpenError(connection, error) -> None:
+	logger.warning(f'Producer could not connect to RabbitMQ: {error}')
+	connection.ioloop.stop()
+	
+	return
+
+###########################################################################
+##	
+##	Puts every unconfirmed message back at the front of the pending queue,
+##	in publish order, and stops the ioloop so RunProducer reconnects
+##	
+###########################################################################
+def OnConnectionClosed(connection, reason) -> None:
+	global producerReady
+	
+	logger.warning(f'Producer lost its RabbitMQ connection: {reason}')
+	
+	with producerLock:
+		producerReady = False
+		
+		for deliveryTag in sorted(unconfirmedMessages.keys(), reverse=True):
+			pendingMessages.appendleft(unconfirmedMessages[deliveryTag])
+		producerStats['republished'] += len(unconfirmedMessages)
+		unconfirmedMessages.clear()
+	
+	connection.ioloop.stop()
+	
+	return
+
+def OnChannelOpen(channel) -> None:
+	global producerChannel
+	
+	producerChannel = channel
+	channel.add_on_close_callback(OnChannelClosed)
+	channel.confirm_delivery(ack_nack_callback=OnDeliveryConfirmation, callback=lambda frame: DeclareQueues(channel, 0))
+	
+	return
+
+def OnChannelClosed(channel, reason) -> None:
+	# a closed channel can't publish anymore, reconnect from scratch
+	if producerConnection.is_open:
+		producerConnection.close()
+	
+	return
+
+def DeclareQueues(channel, index: int) -> None:
+	if index == len(declaredQueues):
+		OnProducerReady()
+		return
+	
+	channel.queue_declare(queue=declaredQueues[index], callback=lambda frame: DeclareQueues(channel, index + 1))
+	
+	return
+
+def OnProducerReady() -> None:
+	global producerReady
+	global nextDeliveryTag
+	
+	# delivery tags start over on every new channel
+	with producerLock:
+		producerReady = True
+		nextDeliveryTag = 0
+	
+	FlushPending()
+	
+	return
+
+###########################################################################
+##	
+##	Queues a message for publishing and returns its ticket.  onConfirm, if
+##	given, is called with the ticket from the producer thread once the
+##	broker has confirmed it, so it must not block.
+##	
+###########################################################################
+def Publish(routingKey: str, body: str, onConfirm=None):
+	global flushScheduled
+	
+	ticket = {
+		'routing_key': routingKey,
+		'body': body,
+		'on_confirm': onConfirm,
+		'queued_at': time.perf_counter(),
+		'confirmed': threading.Event()
+	}
+	
+	with producerLock:
+		pendingMessages.append(ticket)
+		
+		# the first waiting message starts the flush timer, a full batch flushes right away
+		scheduleTimer = flushScheduled == False
+		flushNow = len(pendingMessages) == PRODUCER_BATCH_SIZE
+		flushScheduled = True
+		
+		if producerReady == False:
+			return ticket
+		
+		ioloop = producerConnection.ioloop
+	
+	if flushNow == True:
+		ioloop.add_callback_threadsafe(FlushPending)
+	elif scheduleTimer == True:
+		ioloop.add_callback_threadsafe(lambda: ioloop.call_later(PRODUCER_FLUSH_MS / 1000, FlushPending))
+	
+	return ticket
+
+###########################################################################
+##	
+##	Publishes every pending message.  Runs on the producer thread.
+##	
+###########################################################################
+def FlushPending() -> None:
+	global flushScheduled
+	global nextDeliveryTag
+	
+	with producerLock:
+		flushScheduled = False
+		
+		if producerReady == False:
+			return
+		
+		toPublish = []
+		while len(pendingMessages) > 0:
+			ticket = pendingMessages.popleft()
+			nextDeliveryTag += 1
+			unconfirmedMessages[nextDeliveryTag] = ticket
+			toPublish.append(ticket)
+		
+		producerStats['published'] += len(toPublish)
+	
+	for ticket in toPublish:
+		producerChannel.basic_publish(exchange='',
+									  routing_key=ticket['routing_key'],
+									  body=ticket['body'],
+									  properties=pika.BasicProperties(delivery_mode=2))
+	
+	return
+
+###########################################################################
+##	
+##	Handles a Basic.Ack or Basic.Nack from the broker, which can cover every
+##	delivery tag up to the one given.  Acked tickets are marked confirmed,
+##	nacked ones are queued to be published again.
+##	
+###########################################################################
+def OnDeliveryConfirmation(frame) -> None:
+	global flushScheduled
+	
+	method = frame.method
+	acked = isinstance(method, pika.spec.Basic.Ack)
+	
+	with producerLock:
+		if method.multiple == True:
+			deliveryTags = sorted(deliveryTag for deliveryTag in unconfirmedMessages.keys() if deliveryTag <= method.delivery_tag)
+		else:
+			deliveryTags = [method.delivery_tag]
+		
+		tickets = [unconfirmedMessages.pop(deliveryTag) for deliveryTag in deliveryTags if deliveryTag in unconfirmedMessages]
+		
+		if acked == False:
+			pendingMessages.extend(tickets)
+			producerStats['nacked'] += len(tickets)
+			producerStats['republished'] += len(tickets)
+			flushNow = flushScheduled == False
+			flushScheduled = True
+		else:
+			currTime = time.perf_counter()
+			for ticket in tickets:
+				confirmSeconds = currTime - ticket['queued_at']
+				producerStats['confirmed'] += 1
+				producerStats['confirm_seconds'] += confirmSeconds
+				producerStats['max_confirm_seconds'] = max(producerStats['max_confirm_seconds'], confirmSeconds)
+	
+	if acked == False:
+		if flushNow == True:
+			producerConnection.ioloop.call_later(PRODUCER_FLUSH_MS / 1000, FlushPending)
+		return
+	
+	for ticket in tickets:
+		ticket['confirmed'].set()
+		if ticket['on_confirm'] != None:
+			ticket['on_confirm'](ticket)
+	
+	return
+
+###########################################################################
+##	
+##	Waits for every ticket to be confirmed.  Returns False if timeout
+##	seconds pass first, None waits for as long as it takes.
+##	
+###########################################################################
+def WaitForConfirms(tickets, timeout: float=None) -> bool:
+	deadline = time.monotonic() + timeout if timeout != None else None
+	
+	for ticket in tickets:
+		remaining = deadline - time.monotonic() if deadline != None else None
+		if remaining != None and remaining <= 0:
+			return ticket['confirmed'].is_set()
+		
+		if ticket['confirmed'].wait(timeout=remaining) == False:
+			return False
+	
+	return True
+
+###########################################################################
+##	
+##	Returns publish counters, the number of messages waiting to be
+##	published or confirmed, and the time from Publish() to confirm
+##	
+###########################################################################
+def GetProducerStats():
+	with producerLock:
+		stats = {
+			'published': producerStats['published'],
+			'confirmed': producerStats['confirmed'],
+			'nacked': producerStats['nacked'],
+			'republished': producerStats['republished'],
+			'pending': len(pendingMessages),
+			'unconfirmed': len(unconfirmedMessages),
+			'avg_confirm_ms': producerStats['confirm_seconds'] / producerStats['confirmed'] * 1000 if producerStats['confirmed'] > 0 else 0.0,
+			'max_confirm_ms': producerStats['max_confirm_seconds'] * 1000,
+			'connected': producerReady
+		}
+	
+	return stats
@@ -0,0 +1,128 @@
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+import os
+import requests
+import threading
+import time
+
+###########################################################################
+##	
+##	Shared HTTP client for calls between services.  Keeps one pooled
+##	keep-alive session per target host:port so repeat calls reuse their
+##	TCP connections, applies connect/read timeouts to every request and
+##	keeps per-target latency counters.
+##	
+##	Settings come from the environment, and can be overridden for a single
+##	target by appending its host name, e.g. SERVICE_CLIENT_POOL_SIZE and
+##	SERVICE_CLIENT_POOL_SIZE_USERS_SERVICE.
+##	
+###########################################################################
+
+DEFAULT_POOL_SIZE				= 10
+DEFAULT_CONNECT_TIMEOUT_SECS	= 3.0
+DEFAULT_READ_TIMEOUT_SECS		= 10.0
+
+# sessions by target host:port
+sessions = {}
+sessionsLock = threading.Lock()
+
+# latency counters by target host:port
+targetStats = {}
+targetStatsLock = threading.Lock()
+
+def TargetSetting(name: str, host: str, default):
+	hostName = host.upper().replace('-', '_').replace('.', '_')
+	value = os.environ.get(f'{name}_{hostName}', os.environ.get(name))
+	
+	if value == None:
+		return default
+	
+	return type(default)(value)
+
+###########################################################################
+##	
+##	Returns the session for a target, creating it with a connection pool
+##	of SERVICE_CLIENT_POOL_SIZE the first time the target is called
+##	
+###########################################################################
+def GetSession(target: str, host: str) -> requests.Session:
+	with sessionsLock:
+		session = sessions.get(target)
+		
+		if session == None:
+			poolSize = TargetSetting('SERVICE_CLIENT_POOL_SIZE', host, DEFAULT_POOL_SIZE)
+			adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+			
+			session = requests.Session()
+			session.mount('http://', adapter)
+			session.mount('https://', adapter)
+			sessions[target] = session
+	
+	return session
+
+def RecordRequest(target: str, elapsedSecs: float, failed: bool) -> None:
+	with targetStatsLock:
+		stats = targetStats.setdefault(target, {'requests': 0, 'errors': 0, 'total_secs': 0.0, 'max_secs': 0.0})
+		stats['requests'] += 1
+		stats['total_secs'] += elapsedSecs
+		stats['max_secs'] = max(stats['max_secs'], elapsedSecs)
+		if failed == True:
+			stats['errors'] += 1
+	
+	return
+
+###########################################################################
+##	
+##	Sends a request on the target's pooled session.  Takes the same
+##	arguments as requests.request, timeout defaults to the target's
+##	(connect, read) timeouts.  Connection errors, timeouts and 5xx
+##	responses are counted as errors.
+##	
+###########################################################################
+def Request(method: str, url: str, **kwargs) -> requests.Response:
+	splitUrl = urlsplit(url)
+	target = splitUrl.netloc
+	host = splitUrl.hostname or target
+	
+	if 'timeout' not in kwargs:
+		connectTimeout = TargetSetting('SERVICE_CLIENT_CONNECT_TIMEOUT_SECS', host, DEFAULT_CONNECT_TIMEOUT_SECS)
+		readTimeout = TargetSetting('SERVICE_CLIENT_READ_TIMEOUT_SECS', host, DEFAULT_READ_TIMEOUT_SECS)
+		kwargs['timeout'] = (connectTimeout, readTimeout)
+	
+	session = GetSession(target, host)
+	
+	startTime = time.perf_counter()
+	try:
+		resp = session.request(method, url, **kwargs)
+	except requests.exceptions.RequestException:
+		RecordRequest(target, time.perf_counter() - startTime, True)
+		raise
+	
+	RecordRequest(target, time.perf_counter() - startTime, resp.status_code >= 500)
+	
+	return resp
+
+def Get(url: str, **kwargs) -> requests.Response:
+	return Request('GET', url, **kwargs)
+
+def Post(url: str, **kwargs) -> requests.Response:
+	return Request('POST', url, **kwargs)
+
+###########################################################################
+##	
+##	Returns the latency counters for every target called so far
+##	
+###########################################################################
+def GetLatencyStats():
+	stats = {}
+	
+	with targetStatsLock:
+		for target, targetStat in targetStats.items():
+			stats[target] = {
+				'requests': targetStat['requests'],
+				'errors': targetStat['errors'],
+				'avg_ms': targetStat['total_secs'] / targetStat['requests'] * 1000 if targetStat['requests'] > 0 else 0.0,
+				'max_ms': targetStat['max_secs'] * 1000
+			}
+	
+	return stats
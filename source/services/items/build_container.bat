@@ -1 +1 @@
-docker build -t ecommerce_items .
\ No newline at end of file
+docker build -t ecommerce_items -f Dockerfile ..
\ No newline at end of file
@@ -1,11 +1,21 @@
-from flask import Flask, jsonify, request, make_response
+from flask import Flask, Response, jsonify, request, make_response
 from flask_expects_json import expects_json
+import collections
+import contextlib
+import datetime
 import json
 import logging
 import os
 import pika
-import sqlite3
+import random
+import sys
 import threading
+import time
+
+# pooled db reads and confirmed event publishing
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import db_pool
+import rmq_producer
 
 app = Flask(__name__)
 app.logger.setLevel(logging.INFO)
@@ -16,17 +26,35 @@ SHOPPING_CART_SERVICE_PORT	= 6000
 USERS_SERVICE_PORT			= 7000
 ITEMS_SERVICE_PORT			= 8000
 
-# globals
+# globals, itemsDbConn/dbCursor is the single writer connection and is only
+# used under dbLock, reads go through the read connection pool
+dbPath = None
 itemsDbConn = None
 dbCursor = None
 dbLock = threading.Lock()
 
-# rabbitmq channel
+# reads go through db_pool, which opens up to DB_READ_POOL_SIZE connections
+DB_READ_POOL_SIZE = int(os.environ.get('ITEMS_DB_READ_POOL_SIZE', '8'))
+
+# rabbitmq channel, events are published thru rmq_producer
 rmqChannel = None
-orderItemsValidatedChannel = None
-orderItemsValidatedChannelLock = threading.Lock()
-orderFailedChannel = None
-orderFailedChannelLock = threading.Lock()
+
+# ShoppingCartValidatedQueue batching, orders are validated and committed in
+# groups of up to VALIDATE_BATCH_SIZE messages, waiting at most
+# VALIDATE_BATCH_WAIT_MS for a batch to fill.  a batch size of 1 consumes
+# one message at a time.
+VALIDATE_BATCH_SIZE = int(os.environ.get('ITEMS_VALIDATE_BATCH_SIZE', '1'))
+VALIDATE_BATCH_WAIT_MS = int(os.environ.get('ITEMS_VALIDATE_BATCH_WAIT_MS', '50'))
+
+# in-process item cache, item_id -> item info tuple kept in LRU order, plus
+# a product_name -> item_id index so name lookups hit the same entries
+ITEM_CACHE_SIZE = int(os.environ.get('ITEM_CACHE_SIZE', '50000'))
+itemCache = collections.OrderedDict()
+itemCacheNameIndex = {}
+itemCacheLock = threading.Lock()
+itemCacheGeneration = 0
+itemCacheHits = 0
+itemCacheMisses = 0
 
 @app.route('/')
 def HelloWorld():
@@ -40,6 +68,14 @@ GET_ITEM_INFO_SCHEMA = {
 	}
 }
 
+GET_ITEMS_INFO_SCHEMA = {
+	"type": "object",
+	"properties": {
+		"item_names": {"type": "array", "items": {"type": "string"}},
+		"item_ids": {"type": "array", "items": {"type": "integer"}}
+	}
+}
+
 VALIDATE_ITEMS_SCHEMA = {
 	"$schema": "http://json-schema.org/draft-07/schema#",
 	"items": {
@@ -52,6 +88,67 @@ VALIDATE_ITEMS_SCHEMA = {
 	}
 }
 
+# item info is always returned as (id, price, quantity_in_stock, product_name),
+# with the stock of sharded items summed over their item_stock_shards rows
+ITEM_STOCK_COLUMN = 'CASE WHEN items.stock_shards > 0 ' \
+	'THEN (SELECT SUM(quantity) FROM item_stock_shards WHERE item_id = items.id) ' \
+	'ELSE items.quantity_in_stock END'
+ITEM_INFO_SELECT = f'SELECT id, price, {ITEM_STOCK_COLUMN}, product_name FROM items'
+
+# search result page sizes
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+# rows per chunk when streaming the catalog export
+DEFAULT_EXPORT_CHUNK_SIZE = 1000
+MAX_EXPORT_CHUNK_SIZE = 10000
+
+# number of sub-counters a hot item's stock is split over when promoted
+DEFAULT_STOCK_SHARDS = 8
+MAX_STOCK_SHARDS = 64
+
+SEARCH_ITEMS_SCHEMA = {
+	"type": "object",
+	"properties": {
+		"query": {"type": "string"},
+		"limit": {"type": "integer", "minimum": 1},
+		"cursor": {
+			"type": "object",
+			"properties": {
+				"rank": {"type": "number"},
+				"item_id": {"type": "integer"}
+			},
+			"required": ["rank", "item_id"]
+		}
+	},
+	"required": ["query"]
+}
+
+EXPORT_ITEMS_SCHEMA = {
+	"type": "object",
+	"properties": {
+		"updated_since": {"type": "string"},
+		"chunk_size": {"type": "integer", "minimum": 1}
+	}
+}
+
+PROMOTE_ITEM_STOCK_SCHEMA = {
+	"type": "object",
+	"properties": {
+		"item_id": {"type": "integer"},
+		"shard_count": {"type": "integer", "minimum": 2, "maximum": MAX_STOCK_SHARDS}
+	},
+	"required": ["item_id"]
+}
+
+DEMOTE_ITEM_STOCK_SCHEMA = {
+	"type": "object",
+	"properties": {
+		"item_id": {"type": "integer"}
+	},
+	"required": ["item_id"]
+}
+
 DECREASE_ITEM_QUANTITY_SCHEMA = {
 	"type": "object",
 	"properties": {
@@ -61,32 +158,515 @@ DECREASE_ITEM_QUANTITY_SCHEMA = {
 	"required": ["item_id", "quantity"]
 }
 
+###################################
+#                                 #
+#                                 #
+#           DB POOL               #
+#                                 #
+#                                 #
+###################################
+
+###########################################################################
+##	
+##	Opens the writer connection and resets the read pool and item cache
+##	for the given items db, closing the connections to any previous one
+##	
+###########################################################################
+def ItemsDbInit(path: str) -> None:
+	global dbPath
+	global itemsDbConn
+	global dbCursor
+	
+	dbPath = path
+	
+	# drop pooled connections and cached items from any previously opened db
+	db_pool.PoolInit(dbPath, DB_READ_POOL_SIZE)
+	ItemCacheInvalidate(list(itemCache.keys()))
+	
+	# close the writer on any previously opened db before replacing it
+	if itemsDbConn != None:
+		with dbLock:
+			itemsDbConn.close()
+	
+	itemsDbConn = db_pool.OpenWriteConnection(dbPath)
+	dbCursor = itemsDbConn.cursor()
+	
+	return
+
 ###########################################################################
 ##	
-##	Returns the item ID, quantity, and price from the item name.
+##	Holds dbLock for the duration of the with block, recording the wait
+##	
+###########################################################################
+@contextlib.contextmanager
+def ItemsDbWriteLock():
+	startTime = time.monotonic()
+	
+	with dbLock:
+		db_pool.RecordWait('write', time.monotonic() - startTime)
+		yield
+
+###########################################################################
+##	
+##	Returns pool size and connection wait time metrics
+##	
+###########################################################################
+@app.route('/db_pool_stats', methods=['GET'])
+def GetDbPoolStats():
+	return jsonify(db_pool.GetPoolStats())
+
+###################################
+#                                 #
+#                                 #
+#           ITEM CACHE            #
+#                                 #
+#                                 #
+###################################
+
+###########################################################################
+##	
+##	Returns the cached item info tuple for an item name or ID, or None on
+##	a miss.  Hits move the item to the most recently used end.
+##	
+###########################################################################
+def ItemCacheGet(itemName: str=None, itemId: int=None):
+	global itemCacheHits
+	global itemCacheMisses
+	
+	with itemCacheLock:
+		if itemName != None:
+			itemId = itemCacheNameIndex.get(itemName)
+		
+		item = itemCache.get(itemId) if itemId != None else None
+		
+		if item == None:
+			itemCacheMisses += 1
+			return None
+		
+		itemCache.move_to_end(itemId)
+		itemCacheHits += 1
+	
+	return item
+
+###########################################################################
+##	
+##	Returns the current cache generation.  Read it before querying the db
+##	and pass it to ItemCachePut so a row read before a stock change can't
+##	be cached after that change invalidated it.
+##	
+###########################################################################
+def ItemCacheGeneration() -> int:
+	with itemCacheLock:
+		return itemCacheGeneration
+
+###########################################################################
+##	
+##	Caches an item info tuple, evicting the least recently used items once
+##	the cache is over ITEM_CACHE_SIZE
+##	
+###########################################################################
+def ItemCachePut(item, generation: int) -> None:
+	with itemCacheLock:
+		# stock changed while this row was being read, don't cache it
+		if generation != itemCacheGeneration:
+			return
+		
+		itemCache[item[0]] = item
+		itemCache.move_to_end(item[0])
+		itemCacheNameIndex[item[3]] = item[0]
+		
+		while len(itemCache) > ITEM_CACHE_SIZE:
+			evictedId, evictedItem = itemCache.popitem(last=False)
+			itemCacheNameIndex.pop(evictedItem[3], None)
+	
+	return
+
+###########################################################################
+##	
+##	Drops the given item IDs from the cache, leaving all other items cached
+##	
+###########################################################################
+def ItemCacheInvalidate(itemIds) -> None:
+	global itemCacheGeneration
+	
+	with itemCacheLock:
+		itemCacheGeneration += 1
+		
+		for itemId in itemIds:
+			item = itemCache.pop(itemId, None)
+			if item != None:
+				itemCacheNameIndex.pop(item[3], None)
+	
+	return
+
+###########################################################################
+##	
+##	Commits the writer's open transaction, dropping the changed items from
+##	the cache on both sides of the commit.  The drop before it stops a
+##	reader that read the old row from caching it under the generation that
+##	was current until now, the drop after catches a reader that read the
+##	old row in between.  Called with dbLock held.
+##	
+###########################################################################
+def CommitItemChanges(itemIds) -> None:
+	ItemCacheInvalidate(itemIds)
+	itemsDbConn.commit()
+	ItemCacheInvalidate(itemIds)
+	
+	return
+
+###########################################################################
+##	
+##	Returns item cache hit/miss counters
+##	
+###########################################################################
+@app.route('/item_cache_stats', methods=['GET'])
+def GetItemCacheStats():
+	with itemCacheLock:
+		lookups = itemCacheHits + itemCacheMisses
+		stats = {
+			'hits': itemCacheHits,
+			'misses': itemCacheMisses,
+			'hit_rate': itemCacheHits / lookups if lookups > 0 else 0.0,
+			'size': len(itemCache),
+			'capacity': ITEM_CACHE_SIZE
+		}
+	
+	return jsonify(stats)
+
+###################################
+#                                 #
+#                                 #
+#            ENDPOINTS            #
+#                                 #
+#                                 #
+###################################
+
+###########################################################################
+##	
+##	Returns the item ID, quantity, and price from the item name or ID.
+##	Returns a 404 if no matching item exists.
 ##	
 ###########################################################################
 @app.route('/get_item_info', methods=['GET'])
 @expects_json(GET_ITEM_INFO_SCHEMA)
 def GetItemInfo():
-	global itemsDbConn
-	
 	reqData = request.get_json()
 	
 	if 'item_name' in reqData:
-		searchColumn = 'product_name'
-		searchValue = reqData['item_name']
+		item = ItemCacheGet(itemName=reqData['item_name'])
 	elif 'item_id' in reqData:
-		searchColumn = 'id'
-		searchValue = reqData['item_id']
+		item = ItemCacheGet(itemId=reqData['item_id'])
 	else:
 		return make_response('no valid search criteria specified', 500)
 	
-	dbCursor.execute(f'SELECT id, price, quantity_in_stock, product_name FROM items WHERE {searchColumn} = ?', (searchValue,))
-	item = dbCursor.fetchall()[0]
+	if item != None:
+		return jsonify({'item': item})
+	
+	generation = ItemCacheGeneration()
+	
+	# name lookups go through items_product_name_idx, id lookups through the primary key
+	with db_pool.ReadCursor() as readCursor:
+		if 'item_name' in reqData:
+			readCursor.execute(f'{ITEM_INFO_SELECT} WHERE product_name = ?', (reqData['item_name'],))
+		else:
+			readCursor.execute(f'{ITEM_INFO_SELECT} WHERE id = ?', (reqData['item_id'],))
+		
+		item = readCursor.fetchone()
+	
+	if item == None:
+		return make_response('item not found', 404)
+	
+	ItemCachePut(item, generation)
 	
 	return jsonify({'item': item})
 
+###########################################################################
+##	
+##	Returns item info for a list of item names or IDs with a single IN
+##	query.  Results are in the same order as the request, with null for
+##	any item that wasn't found.
+##	
+###########################################################################
+@app.route('/get_items_info', methods=['GET'])
+@expects_json(GET_ITEMS_INFO_SCHEMA)
+def GetItemsInfo():
+	reqData = request.get_json()
+	
+	# index into the item info tuple used to match results back to the request
+	if 'item_names' in reqData:
+		searchColumn = 'product_name'
+		searchValues = reqData['item_names']
+		keyIndex = 3
+	elif 'item_ids' in reqData:
+		searchColumn = 'id'
+		searchValues = reqData['item_ids']
+		keyIndex = 0
+	else:
+		return make_response('no valid search criteria specified', 500)
+	
+	# only look up each distinct value once, carts often repeat items, and
+	# only go to the db for the ones that aren't cached
+	itemsByKey = {}
+	missingValues = []
+	for value in dict.fromkeys(searchValues):
+		if keyIndex == 0:
+			item = ItemCacheGet(itemId=value)
+		else:
+			item = ItemCacheGet(itemName=value)
+		
+		if item != None:
+			itemsByKey[value] = item
+		else:
+			missingValues.append(value)
+	
+	generation = ItemCacheGeneration()
+	
+	with db_pool.ReadCursor() as readCursor:
+		for start in range(0, len(missingValues), db_pool.MAX_SQL_VARIABLES):
+			chunk = missingValues[start:start + db_pool.MAX_SQL_VARIABLES]
+			placeholders = ', '.join('?' * len(chunk))
+			readCursor.execute(f'{ITEM_INFO_SELECT} WHERE {searchColumn} IN ({placeholders})', chunk)
+			for item in readCursor.fetchall():
+				itemsByKey[item[keyIndex]] = item
+				ItemCachePut(item, generation)
+	
+	items = [itemsByKey.get(value) for value in searchValues]
+	
+	return jsonify({'items': items})
+
+###########################################################################
+##	
+##	Turns free text into an fts5 query.  Every term is quoted so user input
+##	can't be parsed as fts5 syntax, terms are ANDed together, and the last
+##	term matches as a prefix.
+##	
+###########################################################################
+def BuildSearchQuery(text: str) -> str:
+	terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+	
+	if len(terms) == 0:
+		return ''
+	
+	terms[-1] += '*'
+	
+	return ' '.join(terms)
+
+###########################################################################
+##	
+##	Ranked full text search over product names and descriptions.  Results
+##	come back best match first in pages of up to limit items, pass the
+##	returned next_cursor back in to get the following page.
+##	
+###########################################################################
+@app.route('/search_items', methods=['GET'])
+@expects_json(SEARCH_ITEMS_SCHEMA)
+def SearchItems():
+	reqData = request.get_json()
+	
+	searchQuery = BuildSearchQuery(reqData['query'])
+	limit = min(reqData.get('limit', DEFAULT_SEARCH_LIMIT), MAX_SEARCH_LIMIT)
+	
+	if searchQuery == '':
+		return jsonify({'items': [], 'next_cursor': None})
+	
+	# keyset pagination on (rank, id), resume right after the last result of the previous page
+	with db_pool.ReadCursor() as readCursor:
+		if 'cursor' in reqData:
+			cursorRank = reqData['cursor']['rank']
+			cursorItemId = reqData['cursor']['item_id']
+			readCursor.execute(f'SELECT items.id, items.price, {ITEM_STOCK_COLUMN}, items.product_name, items_fts.rank ' \
+				'FROM items_fts JOIN items ON items.id = items_fts.rowid ' \
+				'WHERE items_fts MATCH ? AND (items_fts.rank > ? OR (items_fts.rank = ? AND items_fts.rowid > ?)) ' \
+				'ORDER BY items_fts.rank, items_fts.rowid LIMIT ?', (searchQuery, cursorRank, cursorRank, cursorItemId, limit,))
+		else:
+			readCursor.execute(f'SELECT items.id, items.price, {ITEM_STOCK_COLUMN}, items.product_name, items_fts.rank ' \
+				'FROM items_fts JOIN items ON items.id = items_fts.rowid ' \
+				'WHERE items_fts MATCH ? ' \
+				'ORDER BY items_fts.rank, items_fts.rowid LIMIT ?', (searchQuery, limit,))
+		results = readCursor.fetchall()
+	
+	# items are in the same (id, price, quantity_in_stock, product_name) format as /get_item_info
+	items = [result[:4] for result in results]
+	
+	nextCursor = None
+	if len(results) == limit:
+		nextCursor = {'rank': results[-1][4], 'item_id': results[-1][0]}
+	
+	return jsonify({'items': items, 'next_cursor': nextCursor})
+
+###########################################################################
+##	
+##	Generates the catalog export as NDJSON, one chunk of rows at a time.
+##	Each chunk is a separate keyset query on a pooled read connection, so
+##	memory stays flat no matter how big the catalog is and no connection is
+##	held between chunks.
+##	
+###########################################################################
+def GenerateItemsExport(updatedSince: str, chunkSize: int):
+	columns = f'id, product_name, description, price, {ITEM_STOCK_COLUMN}, updated_at'
+	
+	# full export walks items in id order
+	if updatedSince == None:
+		lastId = 0
+		while True:
+			chunk = FetchExportChunk(f'SELECT {columns} FROM items WHERE id > ? ORDER BY id LIMIT ?', (lastId, chunkSize,))
+			if len(chunk) == 0:
+				break
+			
+			lastId = chunk[-1][0]
+			yield ItemRowsToNdjson(chunk)
+		
+		return
+	
+	# incremental export walks items_updated_at_idx starting just after updated_since, the
+	# max id makes the first (updated_at, id) comparison exclude rows at updated_since itself
+	lastUpdatedAt = updatedSince
+	lastId = 9223372036854775807
+	while True:
+		chunk = FetchExportChunk(f'SELECT {columns} FROM items WHERE (updated_at, id) > (?, ?) AND stock_shards = 0 ' \
+			'ORDER BY updated_at, id LIMIT ?', (lastUpdatedAt, lastId, chunkSize,))
+		if len(chunk) == 0:
+			break
+		
+		lastUpdatedAt = chunk[-1][5]
+		lastId = chunk[-1][0]
+		yield ItemRowsToNdjson(chunk)
+	
+	# sharded items' stock changes without touching updated_at, so they're always included
+	lastId = 0
+	while True:
+		chunk = FetchExportChunk(f'SELECT {columns} FROM items WHERE stock_shards > 0 AND id > ? ORDER BY id LIMIT ?', (lastId, chunkSize,))
+		if len(chunk) == 0:
+			break
+		
+		lastId = chunk[-1][0]
+		yield ItemRowsToNdjson(chunk)
+	
+	return
+
+def FetchExportChunk(query: str, params):
+	with db_pool.ReadCursor() as readCursor:
+		readCursor.execute(query, params)
+		return readCursor.fetchall()
+
+def ItemRowsToNdjson(rows) -> str:
+	lines = []
+	for row in rows:
+		tempItem = {
+			'item_id': row[0],
+			'product_name': row[1],
+			'description': row[2],
+			'price': row[3],
+			'quantity_in_stock': row[4],
+			'updated_at': row[5]
+		}
+		lines.append(json.dumps(tempItem) + '\n')
+	
+	return ''.join(lines)
+
+###########################################################################
+##	
+##	Streams the whole catalog, or only items updated after updated_since,
+##	as NDJSON.  Incremental consumers should pass the highest updated_at
+##	they've seen as updated_since on their next sync.
+##	
+###########################################################################
+@app.route('/export_items', methods=['GET'])
+@expects_json(EXPORT_ITEMS_SCHEMA)
+def ExportItems():
+	reqData = request.get_json()
+	
+	updatedSince = reqData.get('updated_since')
+	chunkSize = min(reqData.get('chunk_size', DEFAULT_EXPORT_CHUNK_SIZE), MAX_EXPORT_CHUNK_SIZE)
+	
+	return Response(GenerateItemsExport(updatedSince, chunkSize), mimetype='application/x-ndjson')
+
+###########################################################################
+##	
+##	Moves an item's stock into sharded mode, splitting quantity_in_stock as
+##	evenly as possible over shard_count sub-counters.  Used for hot items
+##	so their decrements spread over several rows instead of one.
+##	
+###########################################################################
+@app.route('/promote_item_stock', methods=['POST'])
+@expects_json(PROMOTE_ITEM_STOCK_SCHEMA)
+def PromoteItemStock():
+	global itemsDbConn
+	global dbCursor
+	
+	reqData = request.get_json()
+	
+	itemId = reqData['item_id']
+	shardCount = reqData.get('shard_count', DEFAULT_STOCK_SHARDS)
+	
+	with ItemsDbWriteLock():
+		dbCursor.execute('SELECT quantity_in_stock, stock_shards FROM items WHERE id = ?', (itemId,))
+		result = dbCursor.fetchone()
+		
+		if result == None:
+			return make_response('item not found', 404)
+		
+		if result[1] > 0:
+			return make_response('item stock is already sharded', 409)
+		
+		quantity = result[0]
+		shards = [(itemId, shard, quantity // shardCount + (1 if shard < quantity % shardCount else 0),) for shard in range(shardCount)]
+		
+		dbCursor.executemany('INSERT INTO item_stock_shards(item_id, shard, quantity) VALUES (?, ?, ?)', shards)
+		dbCursor.execute('UPDATE items SET quantity_in_stock = 0, stock_shards = ?, updated_at = ? WHERE id = ?', (shardCount, str(datetime.datetime.now()), itemId,))
+		CommitItemChanges([itemId])
+	
+	app.logger.info(f'promoted item_id={itemId} to {shardCount} stock shards')
+	
+	return 'success'
+
+###########################################################################
+##	
+##	Moves an item's stock back to plain mode, summing its sub-counters into
+##	quantity_in_stock
+##	
+###########################################################################
+@app.route('/demote_item_stock', methods=['POST'])
+@expects_json(DEMOTE_ITEM_STOCK_SCHEMA)
+def DemoteItemStock():
+	global itemsDbConn
+	global dbCursor
+	
+	reqData = request.get_json()
+	
+	itemId = reqData['item_id']
+	
+	with ItemsDbWriteLock():
+		dbCursor.execute('SELECT stock_shards FROM items WHERE id = ?', (itemId,))
+		result = dbCursor.fetchone()
+		
+		if result == None:
+			return make_response('item not found', 404)
+		
+		if result[0] == 0:
+			return make_response('item stock is not sharded', 409)
+		
+		dbCursor.execute('SELECT SUM(quantity) FROM item_stock_shards WHERE item_id = ?', (itemId,))
+		quantity = dbCursor.fetchone()[0] or 0
+		
+		dbCursor.execute('DELETE FROM item_stock_shards WHERE item_id = ?', (itemId,))
+		dbCursor.execute('UPDATE items SET quantity_in_stock = ?, stock_shards = 0, updated_at = ? WHERE id = ?', (quantity, str(datetime.datetime.now()), itemId,))
+		CommitItemChanges([itemId])
+	
+	app.logger.info(f'demoted item_id={itemId} to a single stock counter')
+	
+	return 'success'
+
+###########################################################################
+##	
+##	Returns publish and confirm counters for events this service sends
+##	
+###########################################################################
+@app.route('/producer_stats', methods=['GET'])
+def GetProducerStats():
+	return jsonify(rmq_producer.GetProducerStats())
+
 ###################################
 #                                 #
 #                                 #
@@ -109,13 +689,8 @@ def RabbitMqInit():
 	shoppingCartValidatedConsumerThread = threading.Thread(target=SetupRabbitMqShoppingCartValidatedConsumer, daemon=True)
 	shoppingCartValidatedConsumerThread.start()
 	
-	# setup shopping cart validated producer
-	orderItemsValidatedProducerThread = threading.Thread(target=SetupRabbitMqOrderItemsValidatedProducer, daemon=True)
-	orderItemsValidatedProducerThread.start()
-	
-	# setup order failed producer
-	orderFailedProducerThread = threading.Thread(target=SetupRabbitMqOrderFailedProducer, daemon=True)
-	orderFailedProducerThread.start()
+	# setup the order items validated and order failed producer
+	rmq_producer.ProducerInit(os.environ['AMQP_URL'], ['OrderItemsValidatedQueue', 'OrderFailedQueue'])
 	
 	return
 
@@ -167,7 +742,11 @@ def SetupRabbitMqShoppingCartValidatedConsumer():
 	
 	# declare a new queue
 	rmqChannel.queue_declare(queue='ShoppingCartValidatedQueue')
-	rmqChannel.basic_qos(prefetch_count=1)
+	rmqChannel.basic_qos(prefetch_count=max(VALIDATE_BATCH_SIZE, 1))
+	
+	if VALIDATE_BATCH_SIZE > 1:
+		ConsumeShoppingCartValidatedBatches(rmqChannel)
+		return
 	
 	# setup consuming queues
 	rmqChannel.basic_consume(queue='ShoppingCartValidatedQueue',
@@ -182,56 +761,156 @@ def SetupRabbitMqShoppingCartValidatedConsumer():
 
 ###########################################################################
 ##	
-##	Setup RabbitMq order items validated producer
+##	Pulls ShoppingCartValidatedQueue messages in batches of up to
+##	VALIDATE_BATCH_SIZE, handing a batch off once it's full or its first
+##	message has waited VALIDATE_BATCH_WAIT_MS
 ##	
 ###########################################################################
-def SetupRabbitMqOrderItemsValidatedProducer():
-	global orderItemsValidatedChannel
-	
-	# read rabbitmq connection url from environment variable
-	amqpUrl = os.environ['AMQP_URL']
-	urlParams = pika.URLParameters(amqpUrl)
+def ConsumeShoppingCartValidatedBatches(rmqChannel):
+	batchWaitSeconds = VALIDATE_BATCH_WAIT_MS / 1000
 	
-	# connect to rabbitmq
-	connection = pika.BlockingConnection(urlParams)
+	batch = []
+	batchDeadline = 0
 	
-	app.logger.info('Successfully connected to RabbitMQ')
-	orderItemsValidatedChannel = connection.channel()
+	# consume yields (None, None, None) whenever the queue has been idle for batchWaitSeconds
+	for method, properties, body in rmqChannel.consume(queue='ShoppingCartValidatedQueue', inactivity_timeout=batchWaitSeconds):
+		if method != None:
+			if len(batch) == 0:
+				batchDeadline = time.monotonic() + batchWaitSeconds
+			
+			batch.append((method, properties, body))
+		
+		if len(batch) > 0 and (len(batch) >= VALIDATE_BATCH_SIZE or time.monotonic() >= batchDeadline):
+			RmqOrderCreatedBatchCallback(rmqChannel, batch)
+			batch = []
 	
-	orderItemsValidatedChannel.queue_declare(queue='OrderItemsValidatedQueue')
+	return
+
+###########################################################################
+##	
+##	RabbitMq hello world consume callback
+##	
+###########################################################################
+def RmqHelloWorldCb(channel, method, properties, body):
+	data = body.decode('utf-8')
+	app.logger.info(f'RMQ: {data}')
 	
 	return
 
 ###########################################################################
 ##	
-##	Setup RabbitMq order failed producer
+##	Decrements stock for every item in an order inside the caller's open
+##	transaction.  Each update only applies while there's enough stock left,
+##	so the check and the decrement can't be split by another order.  Returns
+##	False on any shortfall, in which case the caller must roll back.
 ##	
 ###########################################################################
-def SetupRabbitMqOrderFailedProducer():
-	global orderFailedChannel
+def DecrementOrderStock(orderItems) -> bool:
+	global dbCursor
 	
-	# read rabbitmq connection url from environment variable
-	amqpUrl = os.environ['AMQP_URL']
-	urlParams = pika.URLParameters(amqpUrl)
+	currTimeStr = str(datetime.datetime.now())
 	
-	# connect to rabbitmq
-	connection = pika.BlockingConnection(urlParams)
+	for item in orderItems:
+		itemId = item['item_id']
+		itemQuantity = item['item_quantity']
+		
+		# plain items are decremented in place
+		dbCursor.execute('UPDATE items SET quantity_in_stock = quantity_in_stock - ?, updated_at = ? WHERE id = ? AND stock_shards = 0 AND quantity_in_stock >= ?', (itemQuantity, currTimeStr, itemId, itemQuantity,))
+		if dbCursor.rowcount == 1:
+			continue
+		
+		# no match means the item is unknown, short on stock, or sharded
+		dbCursor.execute('SELECT stock_shards FROM items WHERE id = ?', (itemId,))
+		result = dbCursor.fetchone()
+		
+		if result == None or result[0] == 0:
+			return False
+		
+		if DecrementShardedStock(itemId, itemQuantity, result[0]) == False:
+			return False
 	
-	app.logger.info('Successfully connected to RabbitMQ')
-	orderFailedChannel = connection.channel()
+	return True
+
+###########################################################################
+##	
+##	Decrements a sharded item's stock inside the caller's open transaction.
+##	The total over all shards is checked first, so a sharded item can't be
+##	oversold either, then the quantity is taken shard by shard starting at
+##	a random shard so concurrent orders land on different rows.
+##	
+###########################################################################
+def DecrementShardedStock(itemId: int, quantity: int, shardCount: int) -> bool:
+	global dbCursor
 	
-	orderFailedChannel.queue_declare(queue='OrderFailedQueue')
+	dbCursor.execute('SELECT shard, quantity FROM item_stock_shards WHERE item_id = ? AND quantity > 0', (itemId,))
+	shards = dbCursor.fetchall()
 	
-	return
+	if sum(shardQuantity for shard, shardQuantity in shards) < quantity:
+		return False
+	
+	startShard = random.randrange(shardCount)
+	shards.sort(key=lambda e: (e[0] - startShard) % shardCount)
+	
+	remaining = quantity
+	for shard, shardQuantity in shards:
+		if remaining == 0:
+			break
+		
+		taken = min(remaining, shardQuantity)
+		dbCursor.execute('UPDATE item_stock_shards SET quantity = quantity - ? WHERE item_id = ? AND shard = ?', (taken, itemId, shard,))
+		remaining -= taken
+	
+	return True
 
 ###########################################################################
 ##	
-##	RabbitMq hello world consume callback
+##	Builds the order failed event for the given order, returns its routing
+##	key and body
 ##	
 ###########################################################################
-def RmqHelloWorldCb(channel, method, properties, body):
-	data = body.decode('utf-8')
-	app.logger.info(f'RMQ: {data}')
+def OrderFailedEvent(parsedData, errorMessage: str):
+	eventData = {
+		'user_id': parsedData['user_id'],
+		'order_id': parsedData['order_id'],
+		'error_message': errorMessage
+	}
+	
+	return ('OrderFailedQueue', json.dumps(eventData))
+
+###########################################################################
+##	
+##	Builds the order items validated event for the given order, returns its
+##	routing key and body
+##	
+###########################################################################
+def OrderItemsValidatedEvent(parsedData):
+	return ('OrderItemsValidatedQueue', json.dumps(parsedData))
+
+###########################################################################
+##	
+##	Fills in item_name for order items that came without one, e.g. from
+##	carts filled before shopping carts stored names, so orders always get
+##	the name as of purchase
+##	
+###########################################################################
+def FillMissingItemNames(orders) -> None:
+	missingIds = list(dict.fromkeys(item['item_id'] for parsedData in orders for item in parsedData['items'] if item.get('item_name') == None))
+	
+	if len(missingIds) == 0:
+		return
+	
+	itemNames = {}
+	with db_pool.ReadCursor() as readCursor:
+		for start in range(0, len(missingIds), db_pool.MAX_SQL_VARIABLES):
+			chunk = missingIds[start:start + db_pool.MAX_SQL_VARIABLES]
+			placeholders = ', '.join('?' * len(chunk))
+			readCursor.execute(f'SELECT id, product_name FROM items WHERE id IN ({placeholders})', chunk)
+			itemNames.update(readCursor.fetchall())
+	
+	for parsedData in orders:
+		for item in parsedData['items']:
+			if item.get('item_name') == None:
+				item['item_name'] = itemNames.get(item['item_id'])
 	
 	return
 
@@ -241,62 +920,87 @@ def RmqHelloWorldCb(channel, method, properties, body):
 ##	
 ###########################################################################
 def RmqOrderCreatedCallback(channel, method, properties, body):
+	RmqOrderCreatedBatchCallback(channel, [(method, properties, body)])
+	
+	return
+
+###########################################################################
+##	
+##	Validates and decrements stock for a batch of orders in a single
+##	transaction.  Each order gets its own savepoint, so an order that's
+##	short on stock is rolled back on its own, exactly as if the orders had
+##	been processed one at a time.  The event each order produces is stored
+##	in processed_orders inside its savepoint, and an order that's already
+##	there is a redelivery, its stock is left alone and the stored event is
+##	published again.  Events are published and the batch is acked only
+##	after the commit.
+##	
+###########################################################################
+def RmqOrderCreatedBatchCallback(channel, messages):
 	global itemsDbConn
 	global dbCursor
-	global dbLock
-	global orderItemsValidatedChannel
-	global orderItemsValidatedChannelLock
 	
-	data = body.decode('utf-8')
-	parsedData = json.loads(data)
-	app.logger.info(f'Items service consumed event in OrderItemsValidatedQueue, data is {json.dumps(parsedData)}')
-	channel.basic_ack(delivery_tag=method.delivery_tag)
+	orders = []
+	for method, properties, body in messages:
+		data = body.decode('utf-8')
+		parsedData = json.loads(data)
+		app.logger.info(f'Items service consumed event in OrderItemsValidatedQueue, data is {json.dumps(parsedData)}')
+		orders.append(parsedData)
 	
-	# list of tuples of (new_quantity, item_id) to write if all quantities are valid
-	dataToInsert = []
+	# names go into the stored events, so they're filled in before the transaction
+	FillMissingItemNames(orders)
 	
-	# validate all items are in stock
-	for item in parsedData['items']:
-		dbCursor.execute('SELECT quantity_in_stock FROM items WHERE id = ?', (item['item_id'],))
-		quantityInStock = dbCursor.fetchone()[0]
-		
-		# if not enough in stock publish order failed event and return
-		if item['item_quantity'] > quantityInStock:
-			eventData = {
-				'user_id': parsedData['user_id'],
-				'order_id': parsedData['order_id'],
-				'error_message': 'not_enough_in_stock'
-			}
-			orderFailedChannel.basic_publish(exchange='',
-												routing_key='OrderFailedQueue',
-												body=json.dumps(eventData),
-												properties=pika.BasicProperties(delivery_mode=2))
+	# routing key and body of the event for each order, in message order
+	events = []
+	changedItemIds = []
+	
+	with ItemsDbWriteLock():
+		try:
+			dbCursor.execute('BEGIN')
 			
-			# order error event pubhlished, we're done here
-			return
-		
-		dataToInsert.append((quantityInStock - item['item_quantity'], item['item_id'],))
+			for parsedData in orders:
+				dbCursor.execute('SAVEPOINT order_stock')
+				
+				validatedEvent = OrderItemsValidatedEvent(parsedData)
+				dbCursor.execute('INSERT OR IGNORE INTO processed_orders(order_id, routing_key, body) VALUES (?, ?, ?)', (parsedData['order_id'],) + validatedEvent)
+				
+				if dbCursor.rowcount == 0:
+					app.logger.info(f'order {parsedData["order_id"]} was already processed, publishing its event again')
+					dbCursor.execute('SELECT routing_key, body FROM processed_orders WHERE order_id = ?', (parsedData['order_id'],))
+					events.append(dbCursor.fetchone())
+				elif DecrementOrderStock(parsedData['items']) == True:
+					events.append(validatedEvent)
+					changedItemIds.extend(item['item_id'] for item in parsedData['items'])
+				else:
+					# the rollback drops the processed_orders row too, store the failure in its place
+					dbCursor.execute('ROLLBACK TO order_stock')
+					failedEvent = OrderFailedEvent(parsedData, 'not_enough_in_stock')
+					dbCursor.execute('INSERT INTO processed_orders(order_id, routing_key, body) VALUES (?, ?, ?)', (parsedData['order_id'],) + failedEvent)
+					events.append(failedEvent)
+				
+				dbCursor.execute('RELEASE order_stock')
+			
+			# only the items in validated orders changed, drop just those from the cache
+			CommitItemChanges(changedItemIds)
+		except Exception:
+			itemsDbConn.rollback()
+			raise
 	
-	# if we got here, all items are valid, decrement stock
-	with dbLock:
-		dbCursor.executemany('UPDATE items SET quantity_in_stock = ? WHERE id = ?', dataToInsert)
-		itemsDbConn.commit()
+	tickets = [rmq_producer.Publish(routingKey, body) for routingKey, body in events]
 	
-	with orderItemsValidatedChannelLock:
-		orderItemsValidatedChannel.basic_publish(exchange='',
-												 routing_key='OrderItemsValidatedQueue',
-												 body=json.dumps(parsedData),
-												 properties=pika.BasicProperties(delivery_mode=2))
-		# app.logger.info(f'Items service published event in OrderItemsValidatedQueue')
+	# the whole batch is published at once and acked once the broker has confirmed
+	# every event, so a crash can't drop an order whose stock was already taken
+	rmq_producer.WaitForConfirms(tickets)
+	
+	# everything up to the last message in the batch has been committed and published
+	channel.basic_ack(delivery_tag=messages[-1][0].delivery_tag, multiple=True)
 	
 	return
 
 if __name__ == '__main__':
-	RabbitMqInit()
+	# open the db before the consumers start, they write to it as soon as they're connected
+	ItemsDbInit('db/items.db')
 	
-	dbPath = 'db/items.db'
-	# check_same_thread = False means the write operations aren't thread safe, but we take care of that with global var dbLock
-	itemsDbConn = sqlite3.connect(database=dbPath, check_same_thread=False)
-	dbCursor = itemsDbConn.cursor()
+	RabbitMqInit()
 	
 	app.run(host='0.0.0.0', port=ITEMS_SERVICE_PORT)
\ No newline at end of file
@@ -1 +1 @@
-docker build -t ecommerce_orders .
\ No newline at end of file
+docker build -t ecommerce_orders -f Dockerfile ..
\ No newline at end of file
@@ -1,12 +1,27 @@
+from aiohttp import web
 from flask import Flask, jsonify, request, make_response
+from concurrent.futures import ThreadPoolExecutor
 from flask_expects_json import expects_json
+from typing import Dict, List
+import asyncio
+import collections
+import datetime
 import json
+import jsonschema
 import logging
 import os
 import pika
+import queue
 import requests
 import sqlite3
+import sys
 import threading
+import time
+
+# outbox publishing and the keep-alive sessions to the users, items and cart services
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import rmq_producer
+import service_client
 
 app = Flask(__name__)
 app.logger.setLevel(logging.INFO)
@@ -18,11 +33,58 @@ dbLock = threading.Lock()
 # channel for publishing hello world events
 rmqHelloWorldChannel		= None
 
-# channel for publishing order created events
-rmqOrderCreatedChannel		= None
-orderCreatedChannelLock		= threading.Lock()
+# order_outbox rows are handed to rmq_producer in batches of OUTBOX_BATCH_SIZE, with
+# at most OUTBOX_MAX_IN_FLIGHT waiting for a confirm, and deleted once confirmed.
+# Purchases and confirms set orderOutboxEvent to wake the publisher, which
+# otherwise checks the table every OUTBOX_POLL_SECS.
+OUTBOX_BATCH_SIZE			= int(os.environ.get('ORDERS_OUTBOX_BATCH_SIZE', '100'))
+OUTBOX_MAX_IN_FLIGHT		= int(os.environ.get('ORDERS_OUTBOX_MAX_IN_FLIGHT', '1000'))
+OUTBOX_POLL_SECS			= float(os.environ.get('ORDERS_OUTBOX_POLL_SECS', '1'))
+orderOutboxEvent			= threading.Event()
+confirmedOutboxIds			= queue.SimpleQueue()
 orderItemsValidatedChannel	= None
 
+# /get_user results by request, LRU ordered.  Entries are used as is until they
+# expire, then revalidated with their etag.  Lookups that found no user are
+# cached for a shorter time so new users show up quickly.
+USER_CACHE_SIZE					= int(os.environ.get('ORDERS_USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL_SECS				= float(os.environ.get('ORDERS_USER_CACHE_TTL_SECS', '60'))
+USER_CACHE_NEGATIVE_TTL_SECS	= float(os.environ.get('ORDERS_USER_CACHE_NEGATIVE_TTL_SECS', '5'))
+userCache = collections.OrderedDict()
+userCacheLock = threading.Lock()
+userCacheHits = 0
+userCacheRevalidations = 0
+userCacheMisses = 0
+
+# item lookups for an order are split into chunks of ITEM_LOOKUP_CHUNK_SIZE ids and
+# fetched in parallel.  The executor is shared by every request, so at most
+# ITEM_LOOKUP_CONCURRENCY lookups are in flight to the items service at once.
+ITEM_LOOKUP_CHUNK_SIZE		= int(os.environ.get('ORDERS_ITEM_LOOKUP_CHUNK_SIZE', '100'))
+ITEM_LOOKUP_CONCURRENCY		= int(os.environ.get('ORDERS_ITEM_LOOKUP_CONCURRENCY', '4'))
+itemLookupExecutor = ThreadPoolExecutor(max_workers=ITEM_LOOKUP_CONCURRENCY, thread_name_prefix='item_lookup')
+
+# /wait_order_status is served by an aiohttp server on its own asyncio loop and
+# port, so a long-poll waiter is a coroutine on an asyncio.Event instead of a
+# blocked request thread.  Waiters are kept by order_id, each entry holds the
+# event, a version bumped on every status change and the number of requests
+# waiting on it, and is only touched on orderStatusLoop.  Status reads run on
+# a small executor so the loop never waits on dbLock.  ORDER_STATUS_MAX_WAITERS
+# is only back-pressure, past it requests get a 503 with Retry-After.
+ORDER_STATUS_SERVICE_PORT		= int(os.environ.get('ORDERS_STATUS_PORT', '5001'))
+ORDER_STATUS_MAX_WAITERS		= int(os.environ.get('ORDERS_MAX_STATUS_WAITERS', '50000'))
+ORDER_STATUS_READ_CONCURRENCY	= int(os.environ.get('ORDERS_STATUS_READ_CONCURRENCY', '4'))
+ORDER_STATUS_LISTEN_BACKLOG		= 4096
+DEFAULT_ORDER_STATUS_WAIT_SECS	= 10
+MAX_ORDER_STATUS_WAIT_SECS		= 30
+orderStatusLoop = None
+orderStatusWaiters = {}
+orderStatusWaiterCount = 0
+orderStatusReadExecutor = ThreadPoolExecutor(max_workers=ORDER_STATUS_READ_CONCURRENCY, thread_name_prefix='order_status_read')
+
+# /get_orders_containing_item returns every matching order unless a limit is
+# given, which is capped at MAX_ORDERS_CONTAINING_ITEM_LIMIT per page
+MAX_ORDERS_CONTAINING_ITEM_LIMIT	= int(os.environ.get('ORDERS_CONTAINING_ITEM_MAX_LIMIT', '1000'))
+
 # constants
 JSON_HEADER_DATATYPE		= {'Content-type': 'application/json'}
 ORDER_SERVICE_PROT			= 5000
@@ -53,7 +115,9 @@ GET_ORDERS_MATCHING_ITEM = {
 	"type": "object",
 	"properties": {
 		"item_name": {"type": "string"},
-		"user_email": {"type": "string"}
+		"user_email": {"type": "string"},
+		"limit": {"type": "integer", "minimum": 1},
+		"after_order_id": {"type": "integer"}
 	},
 	"required": ["item_name"]
 }
@@ -66,42 +130,199 @@ GET_ORDER_STATUS = {
 	"required": ["order_id"]
 }
 
+WAIT_ORDER_STATUS = {
+	"type": "object",
+	"properties": {
+		"order_id": {"type": "integer"},
+		"seen_status": {"type": "string"},
+		"timeout": {"type": "number", "minimum": 0}
+	},
+	"required": ["order_id"]
+}
+
+# validates /wait_order_status requests, which are served outside flask so can't go thru expects_json
+waitOrderStatusValidator = jsonschema.Draft7Validator(WAIT_ORDER_STATUS)
+
+INVALIDATE_USER_CACHE = {
+	"type": "object",
+	"properties": {
+		"user_email": {"type": "string"},
+		"user_id": {"type": "integer"}
+	}
+}
+
 # helper functions
-def GetUserIdFromEmail(email: str) -> int:
-	url = f'http://users_service:{USERS_SERVICE_PORT}/get_user'
-	resp = requests.get(url=url, data=json.dumps({'user_email': email}), headers=JSON_HEADER_DATATYPE)
-	respJson = resp.json()
+
+###########################################################################
+##	
+##	User cache keys, one per /get_user request body
+##	
+###########################################################################
+def UserCacheKey(email: str=None, userId: int=None) -> str:
+	if email != None:
+		return f'user_email:{email}'
 	
-	if len(respJson['results']) == 0:
-		return None
+	return f'user_id:{userId}'
+
+###########################################################################
+##	
+##	Returns the cached (etag, results, expiresAt) entry for a key, or None.
+##	Expired entries are still returned so they can be revalidated.
+##	
+###########################################################################
+def UserCacheGet(cacheKey: str):
+	with userCacheLock:
+		cachedEntry = userCache.get(cacheKey)
+		if cachedEntry != None:
+			userCache.move_to_end(cacheKey)
 	
-	return respJson['results'][0]['user_id']
+	return cachedEntry
 
-def GetUserInfoFromEmailOrId(email=None, userId=None):
+###########################################################################
+##	
+##	Caches /get_user results under cacheKey.  A single user is also cached
+##	under its other key, so an email lookup serves later id lookups and the
+##	other way around.  Evicts least recently used entries past
+##	USER_CACHE_SIZE.
+##	
+###########################################################################
+def UserCachePut(cacheKey: str, etag: str, results) -> None:
+	ttl = USER_CACHE_TTL_SECS if len(results) > 0 else USER_CACHE_NEGATIVE_TTL_SECS
+	cachedEntry = (etag, results, time.monotonic() + ttl)
+	
+	cacheKeys = [cacheKey]
+	if len(results) == 1:
+		cacheKeys = [UserCacheKey(email=results[0]['email']), UserCacheKey(userId=results[0]['user_id'])]
+	
+	with userCacheLock:
+		for key in cacheKeys:
+			userCache[key] = cachedEntry
+			userCache.move_to_end(key)
+		
+		while len(userCache) > USER_CACHE_SIZE:
+			userCache.popitem(last=False)
+	
+	return
+
+###########################################################################
+##	
+##	Drops a user's cache entries by email or id, including the entry under
+##	their other key
+##	
+###########################################################################
+def UserCacheInvalidate(email: str=None, userId: int=None) -> None:
+	with userCacheLock:
+		cachedEntry = userCache.pop(UserCacheKey(email=email, userId=userId), None)
+		
+		if cachedEntry != None and len(cachedEntry[1]) == 1:
+			userCache.pop(UserCacheKey(email=cachedEntry[1][0]['email']), None)
+			userCache.pop(UserCacheKey(userId=cachedEntry[1][0]['user_id']), None)
+	
+	return
+
+def RecordUserCacheLookup(result: str) -> None:
+	global userCacheHits
+	global userCacheRevalidations
+	global userCacheMisses
+	
+	with userCacheLock:
+		if result == 'hit':
+			userCacheHits += 1
+		elif result == 'revalidated':
+			userCacheRevalidations += 1
+		else:
+			userCacheMisses += 1
+	
+	return
+
+###########################################################################
+##	
+##	Looks up users thru /get_user with the user cache in front.  Fresh
+##	entries are returned without a request, expired ones are revalidated
+##	with If-None-Match and reused when the users service answers 304.
+##	
+###########################################################################
+def GetUserResults(email: str=None, userId: int=None):
 	url = f'http://users_service:{USERS_SERVICE_PORT}/get_user'
+	cacheKey = UserCacheKey(email=email, userId=userId)
+	getData = {'user_email': email} if email != None else {'user_id': userId}
 	
-	if email != None:
-		getData = {'user_email': email}
-	elif userId != None:
-		getData = {'user_id': userId}
-	else:
-		return None
+	cachedEntry = UserCacheGet(cacheKey)
+	if cachedEntry != None and cachedEntry[2] > time.monotonic():
+		RecordUserCacheLookup('hit')
+		return cachedEntry[1]
+	
+	headers = dict(JSON_HEADER_DATATYPE)
+	if cachedEntry != None and cachedEntry[0] != None:
+		headers['If-None-Match'] = cachedEntry[0]
+	
+	resp = service_client.Get(url=url, data=json.dumps(getData), headers=headers)
+	
+	if resp.status_code == 304 and cachedEntry != None:
+		RecordUserCacheLookup('revalidated')
+		UserCachePut(cacheKey, cachedEntry[0], cachedEntry[1])
+		return cachedEntry[1]
 	
-	resp = requests.get(url=url, data=json.dumps(getData), headers=JSON_HEADER_DATATYPE)
+	RecordUserCacheLookup('miss')
 	
 	try:
 		respJson = resp.json()
 	except requests.exceptions.JSONDecodeError:
 		return None
 	
+	UserCachePut(cacheKey, resp.headers.get('ETag'), respJson['results'])
+	
+	return respJson['results']
+
+def GetUserIdFromEmail(email: str) -> int:
+	results = GetUserResults(email=email)
+	
+	if results == None or len(results) == 0:
+		return None
+	
+	return results[0]['user_id']
+
+def GetUserInfoFromEmailOrId(email=None, userId=None):
+	if email == None and userId == None:
+		return None
+	
+	results = GetUserResults(email=email, userId=userId)
+	
 	# if no users found, return None
-	if len(respJson['results']) == 0:
+	if results == None or len(results) == 0:
 		return None
 	
-	foundUser = respJson['results'][0]
+	foundUser = results[0]
 	
 	return foundUser
 
+def GetUsersInfoFromEmailsOrIds(emails: List[str]=None, userIds: List[int]=None) -> Dict[int, Dict]:
+	url = f'http://users_service:{USERS_SERVICE_PORT}/get_users'
+	
+	if emails != None:
+		getData = {'user_emails': emails}
+	elif userIds != None:
+		getData = {'user_ids': userIds}
+	else:
+		return None
+	
+	# an item nobody has bought yet leaves no purchasers to resolve
+	if len(emails or userIds) == 0:
+		return {}
+	
+	resp = service_client.Get(url=url, data=json.dumps(getData), headers=JSON_HEADER_DATATYPE)
+	
+	if resp.status_code != 200:
+		return None
+	
+	try:
+		respJson = resp.json()
+	except requests.exceptions.JSONDecodeError:
+		return None
+	
+	# json object keys are always strings, key the users back by their integer id
+	return {int(userId): userInfo for userId, userInfo in respJson['results'].items()}
+
 def GetItemInfoFromNameOrId(itemName: str=None, itemId: int=None) -> int:
 	url = f'http://items_service:{ITEMS_SERVICE_PORT}/get_item_info'
 	
@@ -112,7 +333,11 @@ def GetItemInfoFromNameOrId(itemName: str=None, itemId: int=None) -> int:
 	else:
 		return None
 	
-	resp = requests.get(url=url, data=json.dumps(getData), headers=JSON_HEADER_DATATYPE)
+	resp = service_client.Get(url=url, data=json.dumps(getData), headers=JSON_HEADER_DATATYPE)
+	
+	# item not found
+	if resp.status_code == 404:
+		return None
 	
 	if resp.status_code != 200:
 		return make_response(resp.text, resp.status_code)
@@ -122,10 +347,62 @@ def GetItemInfoFromNameOrId(itemName: str=None, itemId: int=None) -> int:
 	except requests.exceptions.JSONDecodeError:
 		return None
 	
-	# @todo swelter: handle item not found here
-	
 	return respJson['item']
 
+def GetItemsInfoFromNamesOrIds(itemNames: List[str]=None, itemIds: List[int]=None) -> List:
+	url = f'http://items_service:{ITEMS_SERVICE_PORT}/get_items_info'
+	
+	if itemNames != None:
+		getData = {'item_names': itemNames}
+	elif itemIds != None:
+		getData = {'item_ids': itemIds}
+	else:
+		return None
+	
+	# the callers' chunking never sends an empty list, but an empty one has nothing to price
+	if len(itemNames or itemIds) == 0:
+		return []
+	
+	resp = service_client.Get(url=url, data=json.dumps(getData), headers=JSON_HEADER_DATATYPE)
+	
+	if resp.status_code != 200:
+		return None
+	
+	try:
+		respJson = resp.json()
+	except requests.exceptions.JSONDecodeError:
+		return None
+	
+	# same order as the request, None for items that weren't found
+	return respJson['items']
+
+###########################################################################
+##	
+##	Looks up item info for a list of item IDs, keyed by item_id.  Each
+##	distinct id is looked up once, in chunks of ITEM_LOOKUP_CHUNK_SIZE
+##	spread over the shared lookup executor.  Items that weren't found map
+##	to None, and None is returned if any chunk fails.
+##	
+###########################################################################
+def GetItemsInfoByIds(itemIds: List[int]) -> Dict[int, List]:
+	distinctIds = list(dict.fromkeys(itemIds))
+	chunks = [distinctIds[start:start + ITEM_LOOKUP_CHUNK_SIZE] for start in range(0, len(distinctIds), ITEM_LOOKUP_CHUNK_SIZE)]
+	
+	# a single chunk isn't worth the hand off to another thread
+	if len(chunks) <= 1:
+		chunkResults = [GetItemsInfoFromNamesOrIds(itemIds=chunk) for chunk in chunks]
+	else:
+		chunkResults = list(itemLookupExecutor.map(lambda chunk: GetItemsInfoFromNamesOrIds(itemIds=chunk), chunks))
+	
+	itemsInfo = {}
+	for chunk, chunkResult in zip(chunks, chunkResults):
+		if chunkResult == None:
+			return None
+		
+		itemsInfo.update(zip(chunk, chunkResult))
+	
+	return itemsInfo
+
 @app.route('/')
 def HelloWorld():
 	global rmqHelloWorldChannel
@@ -149,7 +426,7 @@ def QueueAddItem():
 	# Simply ensure a cart exists
 	url = f'http://sc_service:{SHOPPING_CART_SERVICE_PORT}/get_or_create_cart'
 	postData = {'user_id': userId}
-	resp = requests.post(url=url, data=json.dumps(postData), headers=JSON_HEADER_DATATYPE)
+	resp = service_client.Post(url=url, data=json.dumps(postData), headers=JSON_HEADER_DATATYPE)
 	
 	# if something failed here, it's quite bad, just return error
 	if resp.status_code != 200:
@@ -157,7 +434,11 @@ def QueueAddItem():
 	
 	url = f'http://sc_service:{SHOPPING_CART_SERVICE_PORT}/add_item_to_cart'
 	postData = {'user_id': userId, 'item_name': reqData['item_name'], 'quantity': reqData['quantity']}
-	resp = requests.post(url=url, data=json.dumps(postData), headers=JSON_HEADER_DATATYPE)
+	resp = service_client.Post(url=url, data=json.dumps(postData), headers=JSON_HEADER_DATATYPE)
+	
+	# pass unknown items straight back to the caller
+	if resp.status_code == 404:
+		return make_response(resp.text, 404)
 	
 	if resp.status_code != 200:
 		return make_response(resp.text, 500)
@@ -178,7 +459,7 @@ def GetQueuedItems():
 	
 	url = f'http://sc_service:{SHOPPING_CART_SERVICE_PORT}/get_cart_items'
 	getData = {'user_id': userId}
-	resp = requests.get(url=url, data=json.dumps(getData), headers=JSON_HEADER_DATATYPE)
+	resp = service_client.Get(url=url, data=json.dumps(getData), headers=JSON_HEADER_DATATYPE)
 	
 	# if no cart found, return empty item list
 	if resp.status_code == 500:
@@ -202,8 +483,6 @@ def GetQueuedItems():
 @app.route('/purchase_queue', methods=['POST'])
 @expects_json(GET_PURCHASE_QUEUED_ITEMS)
 def PurchaseQueuedItems():
-	global rmqOrderCreatedChannel
-	global orderCreatedChannelLock
 	global orderDbConn
 	global dbCursor
 	global dbLock
@@ -211,26 +490,24 @@ def PurchaseQueuedItems():
 	reqData = request.get_json()
 	
 	userId = GetUserIdFromEmail(email=reqData['user_email'])
-
+	
 	if userId == None:
 		return make_response('no user found with that cart', 500)
 	
-	with orderCreatedChannelLock:
-		with dbLock:
-			dbCursor.execute('INSERT INTO orders(user_id, status) VALUES (?, ?)', (userId, 'pending',))
-			orderDbConn.commit()
-			orderId = dbCursor.lastrowid
+	# the order and its order created event are committed together, the outbox
+	# publisher sends the event so a crash can't leave an order without one
+	with dbLock:
+		dbCursor.execute('INSERT INTO orders(user_id, status) VALUES (?, ?)', (userId, 'pending',))
+		orderId = dbCursor.lastrowid
 		
-		# publish order created event
 		eventData = {
 			'user_id': userId,
 			'order_id': orderId
 		}
-		rmqOrderCreatedChannel.basic_publish(exchange='',
-											 routing_key='OrderCreatedQueue',
-											 body=json.dumps(eventData),
-											 properties=pika.BasicProperties(delivery_mode=2))
-		# app.logger.info('Order service published event in OrderCreatedQueue')
+		dbCursor.execute('INSERT INTO order_outbox(routing_key, body, created_at) VALUES (?, ?, ?)', ('OrderCreatedQueue', json.dumps(eventData), str(datetime.datetime.now()),))
+		orderDbConn.commit()
+	
+	orderOutboxEvent.set()
 	
 	return jsonify({'order_id': orderId})
 
@@ -248,7 +525,7 @@ def ClearQueuedItems():
 	
 	url = f'http://sc_service:{SHOPPING_CART_SERVICE_PORT}/cancel_cart'
 	postData = {'user_id': userId}
-	resp = requests.post(url=url, data=json.dumps(postData), headers=JSON_HEADER_DATATYPE)
+	resp = service_client.Post(url=url, data=json.dumps(postData), headers=JSON_HEADER_DATATYPE)
 	
 	# if there was an error cancelling the queue, return it
 	if resp.status_code != 200:
@@ -258,43 +535,68 @@ def ClearQueuedItems():
 
 ###########################################################################
 ##	
-##	Get all orders containing matching item
+##	Get all orders containing matching item, read from the item_orders
+##	index in order_id order.  Popular items can be paged by passing limit,
+##	and the order_id of the last result as after_order_id for the next page.
 ##	
 ###########################################################################
 @app.route('/get_orders_containing_item', methods=['GET'])
 @expects_json(GET_ORDERS_MATCHING_ITEM)
 def GetOrdersContainingItem():
+	global dbCursor
+	global dbLock
+	
 	reqData = request.get_json()
 	
 	itemInfo = GetItemInfoFromNameOrId(itemName=reqData['item_name'])
 	
-	# if user email is supplied, filter by the ID, otherwise just get all purchased carts
+	# an unknown item can't be in any orders
+	if itemInfo == None:
+		return jsonify([])
+	
+	query = 'SELECT order_id, user_id FROM item_orders WHERE item_id = ? AND order_id > ?'
+	params = [itemInfo[0], reqData.get('after_order_id', 0)]
+	
+	# if user email is supplied, filter by the ID, otherwise return orders by every user
 	if 'user_email' in reqData:
 		userId = GetUserIdFromEmail(email=reqData['user_email'])
 		
-		dbCursor.execute('SELECT id FROM orders WHERE user_id = ? AND status == "purchased"', (userId,))
-		ordersToSearch = dbCursor.fetchall()
-	else:
-		dbCursor.execute('SELECT id FROM orders WHERE status == "purchased"')
-		ordersToSearch = dbCursor.fetchall()
-	
-	# go thru all orders that match search criteria, and extract order_id whenever the order contains the matching item_id
-	ordersContainingItem = []
-	for order in ordersToSearch:
-		dbCursor.execute('SELECT order_id FROM order_items WHERE item_id = ? AND order_id = ?', (itemInfo[0], order[0],))
-		results = dbCursor.fetchall()
-		for result in results:
-			if result[0] not in ordersContainingItem:
-				ordersContainingItem.append(result[0])
+		# an unknown user has no orders
+		if userId == None:
+			return jsonify([])
+		
+		query += ' AND user_id = ?'
+		params.append(userId)
+	
+	query += ' ORDER BY order_id'
+	
+	if 'limit' in reqData:
+		query += ' LIMIT ?'
+		params.append(min(reqData['limit'], MAX_ORDERS_CONTAINING_ITEM_LIMIT))
+	
+	with dbLock:
+		dbCursor.execute(query, params)
+		ordersContainingItem = dbCursor.fetchall()
+	
+	# user_id that purchased each order
+	orderUserIds = {order[0]: order[1] for order in ordersContainingItem}
+	ordersContainingItem = [order[0] for order in ordersContainingItem]
+	
+	# get every purchasing user in one call and join them to the orders locally
+	usersInfo = GetUsersInfoFromEmailsOrIds(userIds=list(set(orderUserIds[orderId] for orderId in ordersContainingItem)))
+	
+	if usersInfo == None:
+		return make_response('error getting user info for orders', 500)
 	
 	# build list of tuples, where each tuple is (orderId, first and last name, user email)
 	finalResults = []
 	for orderId in ordersContainingItem:
-		# get user_id that purchased the order
-		dbCursor.execute('SELECT user_id FROM orders WHERE id = ?', (orderId,))
-		tempUserId = dbCursor.fetchone()[0]
+		tempUserInfo = usersInfo.get(orderUserIds[orderId])
 		
-		tempUserInfo = GetUserInfoFromEmailOrId(userId=tempUserId)
+		# the users service has no record of whoever placed this order, leave it out rather than fail the whole list
+		if tempUserInfo == None:
+			app.logger.warning(f'No user info for user {orderUserIds[orderId]} who placed order {orderId}, leaving it out of the results')
+			continue
 		
 		tempResult = (
 			orderId,
@@ -330,6 +632,132 @@ def GetOrderStatus():
 	
 	return jsonify({'order_status': orderStatus})
 
+def ReadOrderStatus(orderId: int) -> str:
+	with dbLock:
+		dbCursor.execute('SELECT status FROM orders WHERE id = ?', (orderId,))
+		result = dbCursor.fetchone()
+	
+	if result == None:
+		return ''
+	
+	return result[0]
+
+###########################################################################
+##	
+##	Wakes every /wait_order_status request waiting on the order.  Called
+##	from any thread after a status change has been committed, the waiters
+##	themselves are woken on orderStatusLoop.
+##	
+###########################################################################
+def NotifyOrderStatusChanged(orderId: int) -> None:
+	if orderStatusLoop != None:
+		orderStatusLoop.call_soon_threadsafe(WakeOrderStatusWaiters, orderId)
+	
+	return
+
+def WakeOrderStatusWaiters(orderId: int) -> None:
+	waiter = orderStatusWaiters.get(orderId)
+	
+	# waiters hold on to the event they started waiting on, later ones get a fresh one
+	if waiter != None:
+		waiter['version'] += 1
+		waiter['event'].set()
+		waiter['event'] = asyncio.Event()
+	
+	return
+
+###########################################################################
+##	
+##	Long-polls the status of an order.  Returns as soon as the status is
+##	something other than seen_status ('pending' by default), or the current
+##	status with timed_out set once timeout seconds have passed.  Past
+##	ORDERS_MAX_STATUS_WAITERS concurrent waiters requests get a 503 and
+##	should retry after backing off.
+##	
+###########################################################################
+async def WaitOrderStatus(request: web.Request) -> web.Response:
+	global orderStatusWaiterCount
+	
+	try:
+		reqData = await request.json()
+	except ValueError:
+		return web.Response(text='request body must be json', status=400)
+	
+	validationError = jsonschema.exceptions.best_match(waitOrderStatusValidator.iter_errors(reqData))
+	if validationError != None:
+		return web.Response(text=validationError.message, status=400)
+	
+	orderId = reqData['order_id']
+	seenStatus = reqData.get('seen_status', 'pending')
+	timeout = min(reqData.get('timeout', DEFAULT_ORDER_STATUS_WAIT_SECS), MAX_ORDER_STATUS_WAIT_SECS)
+	
+	if orderStatusWaiterCount >= ORDER_STATUS_MAX_WAITERS:
+		return web.Response(text='too many order status waiters', status=503, headers={'Retry-After': '1'})
+	
+	orderStatusWaiterCount += 1
+	waiter = orderStatusWaiters.setdefault(orderId, {'event': asyncio.Event(), 'version': 0, 'waiting': 0})
+	waiter['waiting'] += 1
+	
+	loop = asyncio.get_running_loop()
+	try:
+		deadline = loop.time() + timeout
+		while True:
+			# take the version and event before reading the status, a change committed
+			# after the read sets the event and the wait below returns right away
+			version = waiter['version']
+			changed = waiter['event']
+			
+			orderStatus = await loop.run_in_executor(orderStatusReadExecutor, ReadOrderStatus, orderId)
+			if orderStatus != seenStatus:
+				return web.json_response({'order_status': orderStatus, 'timed_out': False})
+			
+			remaining = deadline - loop.time()
+			if remaining <= 0:
+				return web.json_response({'order_status': orderStatus, 'timed_out': True})
+			
+			if waiter['version'] == version:
+				try:
+					await asyncio.wait_for(changed.wait(), timeout=remaining)
+				except asyncio.TimeoutError:
+					pass
+	finally:
+		orderStatusWaiterCount -= 1
+		waiter['waiting'] -= 1
+		if waiter['waiting'] == 0:
+			orderStatusWaiters.pop(orderId, None)
+
+###########################################################################
+##	
+##	Runs the /wait_order_status server on ORDER_STATUS_SERVICE_PORT, on its
+##	own thread and asyncio loop next to the flask app
+##	
+###########################################################################
+def OrderStatusServerInit() -> None:
+	statusServerThread = threading.Thread(target=RunOrderStatusServer, daemon=True)
+	statusServerThread.start()
+	
+	return
+
+def RunOrderStatusServer() -> None:
+	global orderStatusLoop
+	
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	
+	statusApp = web.Application()
+	statusApp.router.add_get('/wait_order_status', WaitOrderStatus)
+	
+	runner = web.AppRunner(statusApp, access_log=None)
+	loop.run_until_complete(runner.setup())
+	loop.run_until_complete(web.TCPSite(runner, host='0.0.0.0', port=ORDER_STATUS_SERVICE_PORT, backlog=ORDER_STATUS_LISTEN_BACKLOG).start())
+	
+	orderStatusLoop = loop
+	app.logger.info(f'Serving /wait_order_status on port {ORDER_STATUS_SERVICE_PORT}')
+	
+	loop.run_forever()
+	
+	return
+
 ###########################################################################
 ##	
 ##	Gets order items
@@ -342,18 +770,32 @@ def GetPurchasedOrderItems():
 	
 	app.logger.info(f'order_id: {reqData["order_id"]}')
 	
-	dbCursor.execute('SELECT item_id, quantity, price FROM order_items WHERE order_id = ?', (reqData['order_id'],))
-	orderItems = dbCursor.fetchall()
+	with dbLock:
+		dbCursor.execute('SELECT item_id, quantity, price, item_name FROM order_items WHERE order_id = ?', (reqData['order_id'],))
+		orderItems = dbCursor.fetchall()
+	
 	app.logger.info(f'{len(orderItems)}')
 	app.logger.info(f'{str(orderItems)}')
 	
+	# names are stored with the order, only rows from before that was done need
+	# a lookup, done for every distinct item in parallel chunks
+	missingIds = [e[0] for e in orderItems if e[3] == None]
+	itemsInfo = {}
+	if len(missingIds) > 0:
+		itemsInfo = GetItemsInfoByIds(missingIds)
+	
+	if itemsInfo == None:
+		return make_response('error getting item info for order', 500)
+	
 	items = []
 	for e in orderItems:
-		itemInfo = GetItemInfoFromNameOrId(itemId=e[0])
+		itemName = e[3]
+		if itemName == None and itemsInfo.get(e[0]) != None:
+			itemName = itemsInfo[e[0]][3]
 		
 		tempItem = {
-			'item_id': itemInfo[0],
-			'item_name': itemInfo[3],
+			'item_id': e[0],
+			'item_name': itemName,
 			'quantity': e[1],
 			'price': e[2]
 		}
@@ -361,10 +803,67 @@ def GetPurchasedOrderItems():
 	
 	return jsonify(items)
 
+###########################################################################
+##	
+##	Returns user cache hit/revalidation/miss counters
+##	
+###########################################################################
+@app.route('/user_cache_stats', methods=['GET'])
+def GetUserCacheStats():
+	with userCacheLock:
+		lookups = userCacheHits + userCacheRevalidations + userCacheMisses
+		stats = {
+			'hits': userCacheHits,
+			'revalidations': userCacheRevalidations,
+			'misses': userCacheMisses,
+			'hit_rate': userCacheHits / lookups if lookups > 0 else 0.0,
+			'size': len(userCache),
+			'capacity': USER_CACHE_SIZE
+		}
+	
+	return jsonify(stats)
+
+###########################################################################
+##	
+##	Returns publish and confirm counters for events this service sends
+##	
+###########################################################################
+@app.route('/producer_stats', methods=['GET'])
+def GetProducerStats():
+	return jsonify(rmq_producer.GetProducerStats())
+
+###########################################################################
+##	
+##	Drops one user from the user cache by email or id
+##	
+###########################################################################
+@app.route('/invalidate_user_cache', methods=['POST'])
+@expects_json(INVALIDATE_USER_CACHE)
+def InvalidateUserCache():
+	reqData = request.get_json()
+	
+	if 'user_email' in reqData:
+		UserCacheInvalidate(email=reqData['user_email'])
+	elif 'user_id' in reqData:
+		UserCacheInvalidate(userId=reqData['user_id'])
+	else:
+		return make_response('no valid search criteria specified', 500)
+	
+	return 'success'
+
+###########################################################################
+##	
+##	Returns latency counters for calls to other services
+##	
+###########################################################################
+@app.route('/service_client_stats', methods=['GET'])
+def GetServiceClientStats():
+	return jsonify(service_client.GetLatencyStats())
+
 @app.route('/test', methods=['GET'])
 def testing():
 	url = f'http://sc_service:{SHOPPING_CART_SERVICE_PORT}/get_open_shopping_carts'
-	resp = requests.get(url=url)
+	resp = service_client.Get(url=url)
 	
 	# app.logger.info(json.dumps(resp.json()))
 	
@@ -389,9 +888,10 @@ def RabbitMqInit():
 	setupHelloWorldPublisherThread = threading.Thread(target=SetupRabbitMqHelloWorldPublisher, daemon=True)
 	setupHelloWorldPublisherThread.start()
 	
-	# setup order created publisher
-	orderCreatedPublisherThread = threading.Thread(target=SetupRabbitMqOrderCreatedPublisher, daemon=True)
-	orderCreatedPublisherThread.start()
+	# setup order created producer, fed from order_outbox
+	rmq_producer.ProducerInit(os.environ['AMQP_URL'], ['OrderCreatedQueue'])
+	orderOutboxPublisherThread = threading.Thread(target=RunOrderOutboxPublisher, daemon=True)
+	orderOutboxPublisherThread.start()
 	
 	# setup order items validated consumer
 	orderItemsValidatedConsumerThread = threading.Thread(target=SetupRabbitMqOrderItemsValidatedConsumer, daemon=True)
@@ -428,23 +928,48 @@ def SetupRabbitMqHelloWorldPublisher():
 
 ###########################################################################
 ##	
-##	Setup RabbitMq order created publisher
+##	Outbox publisher.  Hands order_outbox rows to rmq_producer oldest
+##	first and deletes each row once the broker confirms it.  Rows left
+##	over from a previous run are sent again on startup, so delivery is at
+##	least once.
 ##	
 ###########################################################################
-def SetupRabbitMqOrderCreatedPublisher():
-	global rmqOrderCreatedChannel
-	
-	# read rabbitmq connection url from environment variable
-	amqpUrl = os.environ['AMQP_URL']
-	urlParams = pika.URLParameters(amqpUrl)
+def RunOrderOutboxPublisher() -> None:
+	lastQueuedId = 0
+	inFlight = 0
 	
-	# connect to rabbitmq
-	connection = pika.BlockingConnection(urlParams)
-	
-	app.logger.info('Successfully connected to RabbitMQ')
-	rmqOrderCreatedChannel = connection.channel()
-	
-	rmqOrderCreatedChannel.queue_declare(queue='OrderCreatedQueue')
+	while True:
+		# clear before reading, a purchase or confirm after the read sets it again
+		orderOutboxEvent.clear()
+		
+		confirmedIds = []
+		while confirmedOutboxIds.empty() == False:
+			confirmedIds.append((confirmedOutboxIds.get(),))
+		
+		if len(confirmedIds) > 0:
+			inFlight -= len(confirmedIds)
+			with dbLock:
+				dbCursor.executemany('DELETE FROM order_outbox WHERE id = ?', confirmedIds)
+				orderDbConn.commit()
+		
+		outboxRows = []
+		if inFlight < OUTBOX_MAX_IN_FLIGHT:
+			with dbLock:
+				dbCursor.execute('SELECT id, routing_key, body FROM order_outbox WHERE id > ? ORDER BY id LIMIT ?', (lastQueuedId, min(OUTBOX_BATCH_SIZE, OUTBOX_MAX_IN_FLIGHT - inFlight),))
+				outboxRows = dbCursor.fetchall()
+		
+		for rowId, routingKey, body in outboxRows:
+			rmq_producer.Publish(routingKey, body, onConfirm=lambda ticket, rowId=rowId: OnOutboxRowConfirmed(rowId))
+			lastQueuedId = rowId
+			inFlight += 1
+		
+		if len(outboxRows) == 0:
+			orderOutboxEvent.wait(timeout=OUTBOX_POLL_SECS)
+
+def OnOutboxRowConfirmed(rowId: int) -> None:
+	# runs on the producer thread, leave the delete to the outbox publisher
+	confirmedOutboxIds.put(rowId)
+	orderOutboxEvent.set()
 	
 	return
 
@@ -523,28 +1048,45 @@ def OrderItemsValidatedCallback(channel, method, properties, body):
 	data = body.decode('utf-8')
 	parsedData = json.loads(data)
 	app.logger.info(f'Order service consumed event in OrderItemsValidatedQueue, data is {json.dumps(parsedData)}')
-	channel.basic_ack(delivery_tag=method.delivery_tag)
 	
-	# @todo swelter: mark the order as purchased
 	orderTotal = 0
-	with dbLock:
+	dataToInsert = []
+	for item in parsedData['items']:
+		itemId = item['item_id']
+		itemQuantity = item['item_quantity']
+		itemPrice = item['item_price']
 		
-		# add items to order_items table
-		dataToInsert = []
-		for item in parsedData['items']:
-			itemId = item['item_id']
-			itemQuantity = item['item_quantity']
-			itemPrice = item['item_price']
+		orderTotal += itemPrice * itemQuantity
+		
+		# the name as of purchase, so reads of the order don't need the items service
+		dataToInsert.append((parsedData['order_id'], itemId, itemQuantity, itemPrice, item.get('item_name'),))
+	
+	# the status change and the order's items are one transaction.  Only a pending
+	# order can be finalized, so a redelivered event matches no row and is skipped
+	# without writing anything.
+	with dbLock:
+		try:
+			dbCursor.execute('UPDATE orders SET status = ?, total_price = ? WHERE id = ? AND user_id = ? AND status = ?', ('purchased', orderTotal, parsedData['order_id'], parsedData['user_id'], 'pending',))
+			finalized = dbCursor.rowcount == 1
 			
-			orderTotal += itemPrice * itemQuantity
+			if finalized == True:
+				dbCursor.executemany('INSERT INTO order_items(order_id, item_id, quantity, price, item_name) VALUES (?, ?, ?, ?, ?)', dataToInsert)
+				
+				# index the purchased order under each of its items, an item added to the cart twice is indexed once
+				dbCursor.executemany('INSERT OR IGNORE INTO item_orders(item_id, order_id, user_id) VALUES (?, ?, ?)', [(item[1], parsedData['order_id'], parsedData['user_id'],) for item in dataToInsert])
 			
-			dataToInsert.append((parsedData['order_id'], itemId, itemQuantity, itemPrice,))
-		dbCursor.executemany('INSERT INTO order_items(order_id, item_id, quantity, price) VALUES (?, ?, ?, ?)', dataToInsert)
-		orderDbConn.commit()
-		
-		# mark order as purchased and set the price
-		dbCursor.execute('UPDATE orders SET status = ?, total_price = ? WHERE id = ? AND user_id = ?', ('purchased', orderTotal, parsedData['order_id'], parsedData['user_id'],))
-		orderDbConn.commit()
+			orderDbConn.commit()
+		except Exception:
+			orderDbConn.rollback()
+			raise
+	
+	# only ack once the order is committed, a crash before this gets the event redelivered
+	channel.basic_ack(delivery_tag=method.delivery_tag)
+	
+	if finalized == True:
+		NotifyOrderStatusChanged(parsedData['order_id'])
+	else:
+		app.logger.info(f'Order {parsedData["order_id"]} is no longer pending, skipping duplicate OrderItemsValidatedQueue event')
 	
 	return
 
@@ -561,20 +1103,28 @@ def OrderFailedCallback(channel, method, properties, body):
 	data = body.decode('utf-8')
 	parsedData = json.loads(data)
 	app.logger.info(f'Order service consumed event OrderFailedCallback, data is {json.dumps(parsedData)}')
-	channel.basic_ack(delivery_tag=method.delivery_tag)
 	
-	# set the error message to the order status
+	# set the error message to the order status, like finalization only a pending order
+	# is changed so a redelivered or late failure can't overwrite a finished order
 	with dbLock:
-		dbCursor.execute('UPDATE orders SET status = ? WHERE id = ?', (parsedData['error_message'], parsedData['order_id'],))
+		dbCursor.execute('UPDATE orders SET status = ? WHERE id = ? AND status = ?', (parsedData['error_message'], parsedData['order_id'], 'pending',))
+		failed = dbCursor.rowcount == 1
 		orderDbConn.commit()
 	
+	channel.basic_ack(delivery_tag=method.delivery_tag)
+	
+	if failed == True:
+		NotifyOrderStatusChanged(parsedData['order_id'])
+	
 	return
 
 if __name__ == '__main__':
-	RabbitMqInit()
-	
+	# open the db before the rabbitmq threads start, the outbox publisher reads it right away
 	dbPath = 'db/orders.db'
 	orderDbConn = sqlite3.connect(database=dbPath, check_same_thread=False)
 	dbCursor = orderDbConn.cursor()
 	
+	RabbitMqInit()
+	OrderStatusServerInit()
+	
 	app.run(host='0.0.0.0', port=ORDER_SERVICE_PROT)
\ No newline at end of file
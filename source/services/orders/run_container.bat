@@ -1 +1 @@
-docker run -it -v C:\sandbox\mcc_final_project\db\:/app/db -p 10000:6000 ecommerce_orders:latest
\ No newline at end of file
+docker run -it -v C:\sandbox\mcc_final_project\db\:/app/db -p 10000:6000 -p 10001:5001 ecommerce_orders:latest
\ No newline at end of file
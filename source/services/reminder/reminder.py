@@ -2,11 +2,14 @@ import json
 import logging
 import os
 import pika
-import requests
 import sys
 import threading
 import time
 
+# keep-alive session to the shopping cart service
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import service_client
+
 # globals
 logger = None
 
@@ -33,7 +36,7 @@ def ShoppingCartPolling():
 	
 	url = f'http://sc_service:{SHOPPING_CART_SERVICE_PORT}/get_open_shopping_carts'
 	while True:
-		resp = requests.get(url=url)
+		resp = service_client.Get(url=url)
 		respJson = resp.json()
 		
 		for cartId, userId in respJson:
@@ -1 +1 @@
-docker build -t ecommerce_sc .
\ No newline at end of file
+docker build -t ecommerce_sc -f Dockerfile ..
\ No newline at end of file
@@ -7,7 +7,14 @@ import os
 import pika
 import requests
 import sqlite3
+import sys
 import threading
+import time
+
+# order event publishing and the keep-alive session to the items service
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import rmq_producer
+import service_client
 
 app = Flask(__name__)
 app.logger.setLevel(logging.INFO)
@@ -23,12 +30,15 @@ cartDbConn = None
 dbCursor = None
 dbLock = threading.Lock()
 
-# rabbitmq channel
+# rabbitmq channel, events are published thru rmq_producer
 rmqChannel = None
-shoppingCartValidatedChannel = None
-shoppingCartValidatedChannelLock = threading.Lock()
-orderFailedChannel = None
-orderFailedChannelLock = threading.Lock()
+
+# orders are taken off OrderCreatedQueue up to ORDER_BATCH_SIZE at a time, so
+# one commit and one wait for publisher confirms cover the whole group.  a
+# partial group is handled after ORDER_BATCH_WAIT_MS, set the size to 1 to go
+# back to handling each order on its own.
+ORDER_BATCH_SIZE = int(os.environ.get('SHOPPING_CARTS_ORDER_BATCH_SIZE', '32'))
+ORDER_BATCH_WAIT_MS = int(os.environ.get('SHOPPING_CARTS_ORDER_BATCH_WAIT_MS', '5'))
 
 CREATE_SHOPPING_CART_SCHEMA = {
 	"type": "object",
@@ -76,7 +86,11 @@ def GetItemInfoFromNameOrId(itemName: str=None, itemId: int=None) -> int:
 	else:
 		return None
 	
-	resp = requests.get(url=url, data=json.dumps(getData), headers=JSON_HEADER_DATATYPE)
+	resp = service_client.Get(url=url, data=json.dumps(getData), headers=JSON_HEADER_DATATYPE)
+	
+	# item not found
+	if resp.status_code == 404:
+		return None
 	
 	if resp.status_code != 200:
 		return make_response(resp.text, resp.status_code)
@@ -86,27 +100,48 @@ def GetItemInfoFromNameOrId(itemName: str=None, itemId: int=None) -> int:
 	except requests.exceptions.JSONDecodeError:
 		return None
 	
-	# @todo swelter: handle item not found here
-	
 	return respJson['item']
 
+def GetItemsInfoFromNamesOrIds(itemNames: List[str]=None, itemIds: List[int]=None) -> List:
+	url = f'http://items_service:{ITEMS_SERVICE_PORT}/get_items_info'
+	
+	if itemNames != None:
+		getData = {'item_names': itemNames}
+	elif itemIds != None:
+		getData = {'item_ids': itemIds}
+	else:
+		return None
+	
+	# an empty cart, or one with every item name already stored, needs nothing from the items service
+	if len(itemNames or itemIds) == 0:
+		return []
+	
+	resp = service_client.Get(url=url, data=json.dumps(getData), headers=JSON_HEADER_DATATYPE)
+	
+	if resp.status_code != 200:
+		return None
+	
+	try:
+		respJson = resp.json()
+	except requests.exceptions.JSONDecodeError:
+		return None
+	
+	# same order as the request, None for items that weren't found
+	return respJson['items']
+
 def CalculateTotalPriceOfItems(items: List[Dict]) -> float:
 	totalPrice = 0
 	
-	for index in range(len(items)):
-		url = f'http://items_service:{ITEMS_SERVICE_PORT}/get_item_info'
-		getData = {'item_id': items[index]['item_id']}
-		resp = requests.get(url=url, data=json.dumps(getData), headers=JSON_HEADER_DATATYPE)
-		
-		if resp.status_code != 200:
-			return None
-		
-		try:
-			respJson = resp.json()
-		except requests.exceptions.JSONDecodeError:
+	itemsInfo = GetItemsInfoFromNamesOrIds(itemIds=[item['item_id'] for item in items])
+	
+	if itemsInfo == None:
+		return None
+	
+	for item, itemInfo in zip(items, itemsInfo):
+		if itemInfo == None:
 			return None
 		
-		totalPrice += (respJson['item'][1] * items[index]['quantity'])
+		totalPrice += (itemInfo[1] * item['quantity'])
 	
 	return totalPrice
 
@@ -178,9 +213,13 @@ def AddItemToCart():
 	
 	itemInfo = GetItemInfoFromNameOrId(itemName=reqData['item_name'])
 	
+	if itemInfo == None:
+		return make_response('item not found', 404)
+	
 	with dbLock:
-		dataToInsert = (cartId, itemInfo[0], reqData['quantity'], itemInfo[1],)
-		dbCursor.execute('INSERT INTO shopping_cart_items(cart_id, item_id, quantity, price) VALUES(?, ?, ?, ?)', dataToInsert)
+		# the name is kept with the item so orders carry it without another lookup
+		dataToInsert = (cartId, itemInfo[0], reqData['quantity'], itemInfo[1], itemInfo[3],)
+		dbCursor.execute('INSERT INTO shopping_cart_items(cart_id, item_id, quantity, price, item_name) VALUES(?, ?, ?, ?, ?)', dataToInsert)
 		cartDbConn.commit()
 	
 	return 'success'
@@ -211,17 +250,27 @@ def GetShoppingCartItems():
 	
 	cartId = cartResults[0]
 	
-	dbCursor.execute('SELECT item_id, quantity, price FROM shopping_cart_items WHERE cart_id = ?', (cartId,))
+	dbCursor.execute('SELECT item_id, quantity, price, item_name FROM shopping_cart_items WHERE cart_id = ?', (cartId,))
 	itemResults = dbCursor.fetchall()
 	
 	# list of tuples of cart items, format:
 	#	* item_id
 	#	* quantity
 	#	* price
+	#	* item_name
 	cartItems = []
+	
+	# names are stored with the cart items, only rows added before that need a batch lookup
+	missingIds = [row[0] for row in itemResults if row[3] == None]
+	itemsInfo = GetItemsInfoFromNamesOrIds(itemIds=missingIds)
+	
+	if itemsInfo == None:
+		return make_response('error getting item info for cart', 500)
+	
+	missingNames = {itemId: tempInfo[3] for itemId, tempInfo in zip(missingIds, itemsInfo) if tempInfo != None}
+	
 	for row in itemResults:
-		tempInfo = GetItemInfoFromNameOrId(itemId=row[0])
-		tempItem = {'item_id': row[0], 'quantity': row[1], 'price': row[2], 'item_name': tempInfo[3]}
+		tempItem = {'item_id': row[0], 'quantity': row[1], 'price': row[2], 'item_name': row[3] if row[3] != None else missingNames.get(row[0])}
 		cartItems.append(tempItem)
 	
 	return jsonify({'items': cartItems})
@@ -271,6 +320,24 @@ def GetOpenShoppingCarts():
 	
 	return jsonify(openCarts)
 
+###########################################################################
+##	
+##	Returns latency counters for calls to other services
+##	
+###########################################################################
+@app.route('/service_client_stats', methods=['GET'])
+def GetServiceClientStats():
+	return jsonify(service_client.GetLatencyStats())
+
+###########################################################################
+##	
+##	Returns publish and confirm counters for events this service sends
+##	
+###########################################################################
+@app.route('/producer_stats', methods=['GET'])
+def GetProducerStats():
+	return jsonify(rmq_producer.GetProducerStats())
+
 ###################################
 #                                 #
 #                                 #
@@ -293,13 +360,8 @@ def RabbitMqInit():
 	orderCreatedConsumerThread = threading.Thread(target=SetupRabbitMqOrderCreatedConsumer, daemon=True)
 	orderCreatedConsumerThread.start()
 	
-	# setup shopping cart validated producer
-	shoppingCartValidatedProducerThread = threading.Thread(target=SetupRabbitMqShoppignCartValidatedProducer, daemon=True)
-	shoppingCartValidatedProducerThread.start()
-	
-	# setup order failed producer
-	orderFailedProducerThread = threading.Thread(target=SetupRabbitMqOrderFailedProducer, daemon=True)
-	orderFailedProducerThread.start()
+	# setup the shopping cart validated and order failed producer
+	rmq_producer.ProducerInit(os.environ['AMQP_URL'], ['ShoppingCartValidatedQueue', 'OrderFailedQueue'])
 	
 	return
 
@@ -351,7 +413,11 @@ def SetupRabbitMqOrderCreatedConsumer():
 	
 	# declare a new queue
 	rmqChannel.queue_declare(queue='OrderCreatedQueue')
-	rmqChannel.basic_qos(prefetch_count=1)
+	rmqChannel.basic_qos(prefetch_count=max(ORDER_BATCH_SIZE, 1))
+	
+	if ORDER_BATCH_SIZE > 1:
+		ConsumeOrderCreatedBatches(rmqChannel)
+		return
 	
 	# setup consuming queues
 	rmqChannel.basic_consume(queue='OrderCreatedQueue',
@@ -367,132 +433,142 @@ def SetupRabbitMqOrderCreatedConsumer():
 
 ###########################################################################
 ##	
-##	Setup RabbitMq shopping cart validated producer
+##	Pulls OrderCreatedQueue messages in batches of up to ORDER_BATCH_SIZE,
+##	handing a batch off once it's full or its first message has waited
+##	ORDER_BATCH_WAIT_MS
 ##	
 ###########################################################################
-def SetupRabbitMqShoppignCartValidatedProducer():
-	global shoppingCartValidatedChannel
-	
-	# read rabbitmq connection url from environment variable
-	amqpUrl = os.environ['AMQP_URL']
-	urlParams = pika.URLParameters(amqpUrl)
-	
-	# connect to rabbitmq
-	connection = pika.BlockingConnection(urlParams)
-	
-	app.logger.info('Successfully connected to RabbitMQ')
-	shoppingCartValidatedChannel = connection.channel()
-	
-	shoppingCartValidatedChannel.queue_declare(queue='ShoppingCartValidatedQueue')
+def ConsumeOrderCreatedBatches(rmqChannel):
+	batchWaitSeconds = ORDER_BATCH_WAIT_MS / 1000
+	
+	batch = []
+	batchDeadline = 0
+	
+	# an idle queue still wakes the loop with an empty message, so a partial batch isn't held
+	for method, properties, body in rmqChannel.consume(queue='OrderCreatedQueue', inactivity_timeout=batchWaitSeconds):
+		if method != None:
+			if len(batch) == 0:
+				batchDeadline = time.monotonic() + batchWaitSeconds
+			
+			batch.append((method, properties, body))
+		
+		if len(batch) > 0 and (len(batch) >= ORDER_BATCH_SIZE or time.monotonic() >= batchDeadline):
+			RmqOrderCreatedBatchCallback(rmqChannel, batch)
+			batch = []
 	
 	return
 
 ###########################################################################
 ##	
-##	Setup RabbitMq order failed producer
+##	RabbitMq hello world consume callback
 ##	
 ###########################################################################
-def SetupRabbitMqOrderFailedProducer():
-	global orderFailedChannel
+def RmqHelloWorldCb(channel, method, properties, body):
+	data = body.decode('utf-8')
+	app.logger.info(f'RMQ: {data}')
 	
-	# read rabbitmq connection url from environment variable
-	amqpUrl = os.environ['AMQP_URL']
-	urlParams = pika.URLParameters(amqpUrl)
+	return
+
+###########################################################################
+##	
+##	Closes the user's open cart for an order inside the caller's open
+##	transaction and returns its items, or None if the user has no open
+##	cart.  A redelivered order finds the cart its first delivery closed and
+##	gets the same items again, instead of closing the user's next cart.
+##	
+###########################################################################
+def CloseCartForOrder(userId: int, orderId: int):
+	global dbCursor
 	
-	# connect to rabbitmq
-	connection = pika.BlockingConnection(urlParams)
+	dbCursor.execute('SELECT id FROM shopping_carts WHERE order_id = ?', (orderId,))
+	cartResults = dbCursor.fetchone()
 	
-	app.logger.info('Successfully connected to RabbitMQ')
-	orderFailedChannel = connection.channel()
+	if cartResults != None:
+		app.logger.info(f'cart {cartResults[0]} was already closed for order {orderId}, publishing its items again')
+	else:
+		dbCursor.execute('SELECT id FROM shopping_carts WHERE user_id = ? AND status = "open"', (userId,))
+		cartResults = dbCursor.fetchone()
+		
+		if cartResults == None:
+			return None
+		
+		# mark cart as closed for this order
+		dbCursor.execute('UPDATE shopping_carts SET status = ?, order_id = ? WHERE id = ?', ('closed', orderId, cartResults[0],))
 	
-	orderFailedChannel.queue_declare(queue='OrderFailedQueue')
+	# fetch all items in cart
+	dbCursor.execute('SELECT item_id, quantity, price, item_name FROM shopping_cart_items WHERE cart_id = ?', (cartResults[0],))
 	
-	return
+	return dbCursor.fetchall()
 
 ###########################################################################
 ##	
-##	RabbitMq hello world consume callback
+##	RabbitMq order created consume callback
 ##	
 ###########################################################################
-def RmqHelloWorldCb(channel, method, properties, body):
-	data = body.decode('utf-8')
-	app.logger.info(f'RMQ: {data}')
+def RmqOrderCreatedCallback(channel, method, properties, body):
+	RmqOrderCreatedBatchCallback(channel, [(method, properties, body)])
 	
 	return
 
 ###########################################################################
 ##	
-##	RabbitMq hello world consume callback
+##	Closes the carts for a batch of orders in one transaction, then
+##	publishes an event for each order and acks the batch once the broker
+##	has confirmed all of them
 ##	
 ###########################################################################
-def RmqOrderCreatedCallback(channel, method, properties, body):
+def RmqOrderCreatedBatchCallback(channel, messages):
 	global cartDbConn
-	global dbCursor
 	global dbLock
-	global shoppingCartValidatedChannel
-	global shoppingCartValidatedChannelLock
-	global orderFailedChannel
-	global orderFailedChannelLock
-	
-	data = body.decode('utf-8')
-	parsedData = json.loads(data)
-	app.logger.info(f'Shopping carts service consumed event in OrderCreatedQueue, data is {json.dumps(parsedData)}')
-	channel.basic_ack(delivery_tag=method.delivery_tag)
-	
-	userId = parsedData['user_id']
-	orderId = parsedData['order_id']
-	
-	# @todo swelter: mark shopping cart as closed and fetch all items in the cart
-	# get cart_id from user_Id
-	dbCursor.execute('SELECT id FROM shopping_carts WHERE user_id = ? AND status = "open"', (userId,))
-	cartResults = dbCursor.fetchone()
 	
-	# if no shopping cart found, set status message to data, publish event and return
-	if cartResults == None:
-		parsedData['error_message'] = 'no_sc_found'
-		orderFailedChannel.basic_publish(exchange='',
-											 routing_key='OrderFailedQueue',
-											 body=json.dumps(parsedData),
-											 properties=pika.BasicProperties(delivery_mode=2))
-		
-		# order error event pubhlished, we're done here
-		return
+	orders = []
+	for method, properties, body in messages:
+		data = body.decode('utf-8')
+		parsedData = json.loads(data)
+		app.logger.info(f'Shopping carts service consumed event in OrderCreatedQueue, data is {json.dumps(parsedData)}')
+		orders.append(parsedData)
 	
-	cartId = cartResults[0]
-
-	# mark cart as closed
 	with dbLock:
-		dbCursor.execute('UPDATE shopping_carts SET status = ? WHERE id = ?', ('closed', cartId,))
-		cartDbConn.commit()
-	
-	# fetch all items in cart
-	dbCursor.execute('SELECT item_id, quantity, price FROM shopping_cart_items WHERE cart_id = ?', (cartId,))
-	itemResults = dbCursor.fetchall()
-	
-	orderItems = []
-	for item in itemResults:
-		tempItem = {'item_id': item[0], 'item_quantity': item[1], 'item_price': item[2]}
-		orderItems.append(tempItem)
-	
-	with shoppingCartValidatedChannelLock:
+		try:
+			cartItems = [CloseCartForOrder(parsedData['user_id'], parsedData['order_id']) for parsedData in orders]
+			cartDbConn.commit()
+		except Exception:
+			cartDbConn.rollback()
+			raise
+	
+	tickets = []
+	for parsedData, itemResults in zip(orders, cartItems):
+		# if no shopping cart found, set status message to data and publish the order error event
+		if itemResults == None:
+			parsedData['error_message'] = 'no_sc_found'
+			tickets.append(rmq_producer.Publish('OrderFailedQueue', json.dumps(parsedData)))
+			continue
+		
+		orderItems = []
+		for item in itemResults:
+			tempItem = {'item_id': item[0], 'item_quantity': item[1], 'item_price': item[2], 'item_name': item[3]}
+			orderItems.append(tempItem)
+		
 		eventData = {
-			'user_id': userId,
-			'order_id': orderId,
+			'user_id': parsedData['user_id'],
+			'order_id': parsedData['order_id'],
 			'items': orderItems
 		}
-		shoppingCartValidatedChannel.basic_publish(exchange='',
-												   routing_key='ShoppingCartValidatedQueue',
-												   body=json.dumps(eventData),
-												   properties=pika.BasicProperties(delivery_mode=2))
-		# app.logger.info(f'Shopping cart service published event in ShoppingCartValidatedQueue')
+		tickets.append(rmq_producer.Publish('ShoppingCartValidatedQueue', json.dumps(eventData)))
+	
+	# only ack once the broker has confirmed every event the batch produced, so a crash
+	# or nack before then gets OrderCreatedQueue to redeliver them instead of losing them
+	rmq_producer.WaitForConfirms(tickets)
+	channel.basic_ack(delivery_tag=messages[-1][0].delivery_tag, multiple=True)
 	
 	return
 
 if __name__ == '__main__':
-	RabbitMqInit()
-	
+	# open the db before the rabbitmq threads start, the order created consumer uses it right away
 	dbPath = 'db/shopping_carts.db'
 	cartDbConn = sqlite3.connect(database=dbPath, check_same_thread=False)
 	dbCursor = cartDbConn.cursor()
 	
+	RabbitMqInit()
+	
 	app.run(host='0.0.0.0', port=SHOPPING_CART_SERVICE_PORT)
\ No newline at end of file
@@ -1 +1 @@
-docker build -t ecommerce_users .
\ No newline at end of file
+docker build -t ecommerce_users -f Dockerfile ..
\ No newline at end of file
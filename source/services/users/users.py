@@ -1,16 +1,34 @@
-from flask import Flask, jsonify, request, make_response
+from flask import Flask, Response, jsonify, request, make_response, stream_with_context
 from flask_expects_json import expects_json
+from email.utils import format_datetime
+from werkzeug.http import is_resource_modified
 import datetime
+import hashlib
+import json
+import jsonschema
 import logging
 import os
 import pika
 import sqlite3
+import sys
 import threading
 
+# pooled db reads
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import db_pool
+
 app = Flask(__name__)
 app.logger.setLevel(logging.INFO)
 
+# globals, usersDbConn/dbCursor is the single writer connection and is only
+# used under dbLock, reads go through the read connection pool
 dbPath = None
+usersDbConn = None
+dbCursor = None
+dbLock = threading.Lock()
+
+# reads go through db_pool, which opens up to DB_READ_POOL_SIZE connections
+DB_READ_POOL_SIZE = int(os.environ.get('USERS_DB_READ_POOL_SIZE', '8'))
 
 # rabbitmq channel
 rmqChannel = None
@@ -34,12 +52,50 @@ CREATE_USER_SCHEMA = {
 	"required": ["email", "first_name", "last_name", "phone", "address", "credit_card"]
 }
 
+# validates each row of a bulk create, since those can't go thru expects_json
+createUserValidator = jsonschema.Draft7Validator(CREATE_USER_SCHEMA)
+
 GET_USER_SCHEMA = {
 	"type": "object",
 	"properties": {
 		"user_email": {"type": "string"},
 		"last_name": {"type": "string"},
-		"user_id": {"type": "integer"}
+		"last_name_prefix": {"type": "string"},
+		"user_id": {"type": "integer"},
+		"limit": {"type": "integer", "minimum": 1},
+		"cursor": {
+			"type": "object",
+			"properties": {
+				"last_name": {"type": "string"},
+				"user_id": {"type": "integer"}
+			},
+			"required": ["last_name", "user_id"]
+		},
+		"stream": {"type": "boolean"}
+	}
+}
+
+# last name searches page thru users_last_name_idx in (last_name, id) order
+DEFAULT_LAST_NAME_SEARCH_LIMIT	= 100
+MAX_LAST_NAME_SEARCH_LIMIT		= 1000
+LAST_NAME_STREAM_CHUNK_SIZE		= 1000
+
+# bulk user creation commits every BULK_CREATE_CHUNK_SIZE rows
+BULK_CREATE_CHUNK_SIZE = int(os.environ.get('USERS_BULK_CREATE_CHUNK_SIZE', '1000'))
+
+# indexes created by create_dbs that lookups depend on
+EXPECTED_INDEXES = ['users_email_idx', 'users_last_name_idx', 'user_profiles_user_id_idx']
+
+# user lookups join the profile on, one row per user, in id order.  A user can
+# have more than one profile row, the first one inserted is the one returned.
+USER_SELECT = 'SELECT users.id, users.email, users.first_name, users.last_name, users.updated_at, user_profiles.address, user_profiles.phone ' \
+	'FROM users LEFT JOIN user_profiles ON user_profiles.rowid = (SELECT MIN(rowid) FROM user_profiles WHERE user_profiles.user_id = users.id)'
+
+GET_USERS_SCHEMA = {
+	"type": "object",
+	"properties": {
+		"user_ids": {"type": "array", "items": {"type": "integer"}},
+		"user_emails": {"type": "array", "items": {"type": "string"}}
 	}
 }
 
@@ -47,12 +103,107 @@ GET_USER_SCHEMA = {
 def HelloWorld():
 	return "hello, world"
 
+###################################
+#                                 #
+#                                 #
+#            DB POOL              #
+#                                 #
+#                                 #
+###################################
+
+###########################################################################
+##	
+##	Opens the writer connection for the given users db
+##	
+###########################################################################
+def UsersDbInit(path: str) -> None:
+	global dbPath
+	global usersDbConn
+	global dbCursor
+	
+	dbPath = path
+	db_pool.PoolInit(dbPath, DB_READ_POOL_SIZE)
+	
+	usersDbConn = db_pool.OpenWriteConnection(dbPath)
+	dbCursor = usersDbConn.cursor()
+	
+	CheckUsersDbIndexes()
+	
+	return
+
+###########################################################################
+##	
+##	Warns about any expected index missing from the users db, lookups still
+##	work without them but fall back to full table scans
+##	
+###########################################################################
+def CheckUsersDbIndexes() -> None:
+	dbCursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+	existingIndexes = [row[0] for row in dbCursor.fetchall()]
+	
+	for indexName in EXPECTED_INDEXES:
+		if indexName not in existingIndexes:
+			app.logger.warning(f'users db is missing index {indexName}, run create_dbs.py --migrate')
+	
+	return
+
+###########################################################################
+##	
+##	Converts a USER_SELECT row to the json format returned by /get_user
+##	
+###########################################################################
+def UserRowToJson(row):
+	tempResult = {
+		'user_id': row[0],
+		'email': row[1],
+		'first_name': row[2],
+		'last_name': row[3],
+		'updated_at': row[4],
+		'address': row[5],
+		'phone': row[6]
+	}
+	
+	return tempResult
+
+###########################################################################
+##	
+##	Cache validators for a single user.  The etag and last modified time
+##	both come from updated_at, so anything that changes a user or their
+##	profile must bump users.updated_at.  Rows from before updated_at was
+##	filled in have none, and are served without validators.
+##	
+###########################################################################
+def UserEtag(userId: int, updatedAt: str) -> str:
+	return hashlib.sha1(f'{userId}:{updatedAt}'.encode('utf-8')).hexdigest()
+
+def UserLastModified(updatedAt: str):
+	# updated_at is written as the server's local time, http dates are UTC and only
+	# have second resolution, the etag catches anything finer
+	lastModified = datetime.datetime.fromisoformat(updatedAt)
+	
+	if lastModified.tzinfo == None:
+		lastModified = lastModified.astimezone()
+	
+	return lastModified.astimezone(datetime.timezone.utc).replace(microsecond=0)
+
+###################################
+#                                 #
+#                                 #
+#            ENDPOINTS            #
+#                                 #
+#                                 #
+###################################
+
 # @todo swelter: add schema here
 @app.route('/get_user', methods=['GET'])
 @expects_json(GET_USER_SCHEMA)
 def GetUser():
 	reqData = request.get_json()
 	
+	# paged, prefix and streamed searches; a bare last_name still returns every match at once
+	if 'last_name_prefix' in reqData or ('last_name' in reqData and ('limit' in reqData or 'cursor' in reqData or reqData.get('stream', False) == True)):
+		return SearchUsersByLastName(reqData)
+	
 	if 'last_name' in reqData:
 		searchColumn = 'last_name'
 		searchData = reqData['last_name']
@@ -65,36 +216,154 @@ def GetUser():
 	else:
 		return make_response('no valid search criteria specified', 500)
 	
-	usersConn = sqlite3.connect(database=dbPath)
-	usersCursor = usersConn.cursor()
-	usersCursor.execute(f'SELECT id, email, first_name, last_name, updated_at FROM users WHERE {searchColumn} = ?', (searchData,))
-	usersResults = usersCursor.fetchall()
+	# id and email lookups match at most one user, so a conditional request is answered
+	# from an index-only check of updated_at before the full row is read
+	singleUserLookup = searchColumn != 'last_name'
+	if singleUserLookup and ('If-None-Match' in request.headers or 'If-Modified-Since' in request.headers):
+		with db_pool.ReadCursor() as readCursor:
+			readCursor.execute(f'SELECT id, updated_at FROM users WHERE {searchColumn} = ?', (searchData,))
+			validatorRow = readCursor.fetchone()
+		
+		if validatorRow != None and validatorRow[1] != None:
+			etag = UserEtag(validatorRow[0], validatorRow[1])
+			lastModified = UserLastModified(validatorRow[1])
+			if is_resource_modified(request.environ, etag=etag, last_modified=lastModified) == False:
+				resp = make_response('', 304)
+				resp.set_etag(etag)
+				resp.headers['Last-Modified'] = format_datetime(lastModified, usegmt=True)
+				return resp
 	
-	profilesConn = sqlite3.connect(database=dbPath)
-	profilesCursor = profilesConn.cursor()
+	# users and their profiles come back from one query on a pooled connection
+	with db_pool.ReadCursor() as readCursor:
+		readCursor.execute(f'{USER_SELECT} WHERE users.{searchColumn} = ? ORDER BY users.id', (searchData,))
+		usersResults = readCursor.fetchall()
 	
-	jsonResults = {'results': []}
-	if usersResults:
-		for row in usersResults:
-			tempResult = {}
-			
-			# get basic user information from users table
-			tempResult['user_id'] = row[0]
-			tempResult['email'] = row[1]
-			tempResult['first_name'] = row[2]
-			tempResult['last_name'] = row[3]
-			tempResult['updated_at'] = row[4]
-			
-			# get further information from user_profiles table
-			profilesCursor.execute('SELECT address, phone FROM user_profiles WHERE user_id = ?', (tempResult['user_id'],))
-			profileData = profilesCursor.fetchall()[0]
-			tempResult['address'] = profileData[0]
-			tempResult['phone'] = profileData[1]
-			
-			jsonResults['results'].append(tempResult)
+	jsonResults = {'results': [UserRowToJson(row) for row in usersResults]}
+	
+	resp = jsonify(jsonResults)
+	
+	# validators come from the row that was returned, clients must revalidate before reuse
+	if singleUserLookup and len(usersResults) == 1 and usersResults[0][4] != None:
+		resp.set_etag(UserEtag(usersResults[0][0], usersResults[0][4]))
+		resp.headers['Last-Modified'] = format_datetime(UserLastModified(usersResults[0][4]), usegmt=True)
+		resp.headers['Cache-Control'] = 'no-cache'
+	
+	return resp
+
+###########################################################################
+##	
+##	Returns every user matching a list of user IDs or emails from a single
+##	query, keyed by user_id.  Users that weren't found are left out.
+##	
+###########################################################################
+@app.route('/get_users', methods=['GET'])
+@expects_json(GET_USERS_SCHEMA)
+def GetUsers():
+	reqData = request.get_json()
+	
+	if 'user_ids' in reqData:
+		searchColumn = 'id'
+		searchValues = reqData['user_ids']
+	elif 'user_emails' in reqData:
+		searchColumn = 'email'
+		searchValues = reqData['user_emails']
+	else:
+		return make_response('no valid search criteria specified', 500)
+	
+	distinctValues = list(dict.fromkeys(searchValues))
+	
+	jsonResults = {'results': {}}
+	with db_pool.ReadCursor() as readCursor:
+		for start in range(0, len(distinctValues), db_pool.MAX_SQL_VARIABLES):
+			chunk = distinctValues[start:start + db_pool.MAX_SQL_VARIABLES]
+			placeholders = ', '.join('?' * len(chunk))
+			readCursor.execute(f'{USER_SELECT} WHERE users.{searchColumn} IN ({placeholders})', chunk)
+			for row in readCursor.fetchall():
+				jsonResults['results'][row[0]] = UserRowToJson(row)
 	
 	return jsonify(jsonResults)
 
+###########################################################################
+##	
+##	Builds the where clause for a last name search.  Prefix matches are a
+##	range on users_last_name_idx rather than a LIKE, which sqlite can't
+##	serve from the index with its default case insensitive LIKE.
+##	
+###########################################################################
+def LastNameSearchClause(reqData):
+	if 'last_name_prefix' not in reqData:
+		return 'users.last_name = ?', [reqData['last_name']]
+	
+	prefix = reqData['last_name_prefix']
+	if prefix == '':
+		return '1 = 1', []
+	
+	# every name starting with prefix sorts before prefix with its last character bumped
+	if ord(prefix[-1]) < 0x10FFFF:
+		return 'users.last_name >= ? AND users.last_name < ?', [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+	
+	return 'users.last_name >= ? AND substr(users.last_name, 1, ?) = ?', [prefix, len(prefix), prefix]
+
+###########################################################################
+##	
+##	Fetches up to limit users matching whereClause that come after the
+##	(last_name, user_id) cursor, in (last_name, id) order
+##	
+###########################################################################
+def FetchLastNamePage(whereClause: str, params, cursor, limit: int):
+	if cursor != None:
+		whereClause = f'{whereClause} AND (users.last_name, users.id) > (?, ?)'
+		params = params + [cursor['last_name'], cursor['user_id']]
+	
+	with db_pool.ReadCursor() as readCursor:
+		readCursor.execute(f'{USER_SELECT} WHERE {whereClause} ORDER BY users.last_name, users.id LIMIT ?', params + [limit])
+		return readCursor.fetchall()
+
+def LastNameCursor(row):
+	return {'last_name': row[3], 'user_id': row[0]}
+
+###########################################################################
+##	
+##	Generates every match as NDJSON, one keyset page at a time.  Each page
+##	checks a connection out of the pool and returns it, so memory stays
+##	flat and a slow client never holds a connection.
+##	
+###########################################################################
+def GenerateLastNameStream(whereClause: str, params, cursor):
+	while True:
+		page = FetchLastNamePage(whereClause, params, cursor, LAST_NAME_STREAM_CHUNK_SIZE)
+		if len(page) == 0:
+			break
+		
+		cursor = LastNameCursor(page[-1])
+		yield ''.join(json.dumps(UserRowToJson(row)) + '\n' for row in page)
+	
+	return
+
+###########################################################################
+##	
+##	Searches by exact last_name or by last_name_prefix.  Results come back
+##	in pages of up to limit users, pass the returned next_cursor back in
+##	to get the following page.  With stream set every remaining match is
+##	streamed as NDJSON instead.
+##	
+###########################################################################
+def SearchUsersByLastName(reqData):
+	whereClause, params = LastNameSearchClause(reqData)
+	cursor = reqData.get('cursor')
+	
+	if reqData.get('stream', False) == True:
+		return Response(GenerateLastNameStream(whereClause, params, cursor), mimetype='application/x-ndjson')
+	
+	limit = min(reqData.get('limit', DEFAULT_LAST_NAME_SEARCH_LIMIT), MAX_LAST_NAME_SEARCH_LIMIT)
+	page = FetchLastNamePage(whereClause, params, cursor, limit)
+	
+	nextCursor = None
+	if len(page) == limit:
+		nextCursor = LastNameCursor(page[-1])
+	
+	return jsonify({'results': [UserRowToJson(row) for row in page], 'next_cursor': nextCursor})
+
 @app.route('/create_user', methods=['POST'])
 @expects_json(CREATE_USER_SCHEMA)
 def CreateUser():
@@ -103,26 +372,131 @@ def CreateUser():
 	
 	reqData = request.get_json()
 	
-	usersConn = sqlite3.connect(database=dbPath)
-	usersCursor = usersConn.cursor()
-	
 	currTimeStr = str(datetime.datetime.now())
 	
-	# create user in users table
-	dataToInsert = (reqData['email'], reqData['first_name'], reqData['last_name'], currTimeStr, currTimeStr,)
-	usersCursor.execute('INSERT INTO users(email, first_name, last_name, created_at, updated_at) VALUES (?, ?, ?, ?, ?)', dataToInsert)
-	usersConn.commit()
-	userId = usersCursor.lastrowid
-	
-	# create user profile in user_profiles table
-	profilesConn = sqlite3.connect(database=dbPath)
-	profilesCursor = profilesConn.cursor()
-	dataToInsert = (userId, reqData['address'], reqData['phone'], reqData['credit_card'],)
-	profilesCursor.execute('INSERT INTO user_profiles(user_id, address, phone, credit_card) VALUES(?, ?, ?, ?)', dataToInsert)
-	profilesConn.commit()
+	# the user and their profile are written in one transaction
+	with dbLock:
+		# create user in users table
+		dataToInsert = (reqData['email'], reqData['first_name'], reqData['last_name'], currTimeStr, currTimeStr,)
+		try:
+			dbCursor.execute('INSERT INTO users(email, first_name, last_name, created_at, updated_at) VALUES (?, ?, ?, ?, ?)', dataToInsert)
+		except sqlite3.IntegrityError:
+			usersDbConn.rollback()
+			return make_response('user with that email already exists', 409)
+		userId = dbCursor.lastrowid
+		
+		# create user profile in user_profiles table, a failure takes the user row back out too
+		dataToInsert = (userId, reqData['address'], reqData['phone'], reqData['credit_card'],)
+		try:
+			dbCursor.execute('INSERT INTO user_profiles(user_id, address, phone, credit_card) VALUES(?, ?, ?, ?)', dataToInsert)
+			usersDbConn.commit()
+		except Exception:
+			usersDbConn.rollback()
+			raise
 	
 	return 'success'
 
+###########################################################################
+##	
+##	Creates users from a JSON array, or from an NDJSON stream when the
+##	content type is application/x-ndjson.  Rows are written in chunked
+##	transactions and every row gets a result with its index and either the
+##	new user_id or an error, a bad row never stops the rest of the batch.
+##	NDJSON requests get their results streamed back as NDJSON.
+##	
+###########################################################################
+@app.route('/create_users', methods=['POST'])
+def CreateUsers():
+	if request.mimetype == 'application/x-ndjson':
+		resultsGenerator = BulkCreateUsers(ReadNdjsonRows(request.stream))
+		return Response(stream_with_context(json.dumps(result) + '\n' for result in resultsGenerator), mimetype='application/x-ndjson')
+	
+	rows = request.get_json(silent=True)
+	if isinstance(rows, list) == False:
+		return make_response('expected a json array of users', 400)
+	
+	return jsonify({'results': list(BulkCreateUsers(rows))})
+
+def ReadNdjsonRows(stream):
+	for line in stream:
+		line = line.strip()
+		if len(line) == 0:
+			continue
+		
+		# rows that aren't valid json are passed on as None and reported as errors
+		try:
+			yield json.loads(line)
+		except ValueError:
+			yield None
+
+###########################################################################
+##	
+##	Inserts users and profiles for every row, committing once per
+##	BULK_CREATE_CHUNK_SIZE rows and yielding one result per row
+##	
+###########################################################################
+def BulkCreateUsers(rows):
+	chunk = []
+	index = 0
+	
+	for row in rows:
+		chunk.append((index, row))
+		index += 1
+		
+		if len(chunk) >= BULK_CREATE_CHUNK_SIZE:
+			yield from InsertUsersChunk(chunk)
+			chunk = []
+	
+	if len(chunk) > 0:
+		yield from InsertUsersChunk(chunk)
+	
+	return
+
+def InsertUsersChunk(chunk):
+	results = []
+	currTimeStr = str(datetime.datetime.now())
+	
+	# anything unexpected rolls back the whole chunk, so no half written rows are
+	# left on the shared writer connection for the next commit to save
+	with dbLock:
+		try:
+			for index, row in chunk:
+				if row == None:
+					results.append({'index': index, 'error': 'invalid json'})
+					continue
+				
+				validationError = jsonschema.exceptions.best_match(createUserValidator.iter_errors(row))
+				if validationError != None:
+					results.append({'index': index, 'error': validationError.message})
+					continue
+				
+				# a failed insert only undoes that statement, the rest of the chunk is kept
+				dataToInsert = (row['email'], row['first_name'], row['last_name'], currTimeStr, currTimeStr,)
+				try:
+					dbCursor.execute('INSERT INTO users(email, first_name, last_name, created_at, updated_at) VALUES (?, ?, ?, ?, ?)', dataToInsert)
+				except sqlite3.IntegrityError:
+					results.append({'index': index, 'error': 'user with that email already exists'})
+					continue
+				userId = dbCursor.lastrowid
+				
+				# a user without a profile would be half created, take the user row back out
+				dataToInsert = (userId, row['address'], row['phone'], row['credit_card'],)
+				try:
+					dbCursor.execute('INSERT INTO user_profiles(user_id, address, phone, credit_card) VALUES(?, ?, ?, ?)', dataToInsert)
+				except sqlite3.DatabaseError:
+					dbCursor.execute('DELETE FROM users WHERE id = ?', (userId,))
+					results.append({'index': index, 'error': 'error creating user profile'})
+					continue
+				
+				results.append({'index': index, 'user_id': userId})
+			
+			usersDbConn.commit()
+		except Exception:
+			usersDbConn.rollback()
+			raise
+	
+	return results
+
 ###################################
 #                                 #
 #                                 #
@@ -184,8 +558,8 @@ def RmqHelloWorldCb(channel, method, properties, body):
 	return
 
 if __name__ == '__main__':
-	RabbitMqInit()
+	UsersDbInit('db/users.db')
 	
-	dbPath = 'db/users.db'
+	RabbitMqInit()
 	
 	app.run(host='0.0.0.0', port=USERS_SERVICE_PORT)
\ No newline at end of file